@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+import argparse
+import array
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import time
+import websockets
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+TIMESTAMP = struct.Struct("!d")   # send time at the start of every benchmark payload
+CONNECT_CONCURRENCY = 100         # handshakes in flight per client process
+SAMPLE_INTERVAL = 0.5             # seconds between server RSS/CPU samples
+IDLE_SETTLE = 2.0                 # seconds to let the server settle before measuring RSS
+
+
+def wait_for_port(port, timeout=10):
+    """Wait until the server accepts TCP connections"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server did not start on port {port}")
+
+
+def process_tree(pid):
+    """The server process and its workers, found through /proc"""
+    pids = [pid]
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(entry))
+    return pids
+
+
+def resource_usage(pid):
+    """(RSS bytes, CPU seconds, sample time) for a process tree, or None without /proc"""
+    if not os.path.isdir("/proc"):
+        return None
+    rss = cpu = 0
+    ticks = os.sysconf("SC_CLK_TCK")
+    page = os.sysconf("SC_PAGE_SIZE")
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{p}/statm") as f:
+                resident = int(f.read().split()[1])
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+        rss += resident * page
+    return rss, cpu, time.time()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(fraction * len(values)))
+    return values[index]
+
+
+async def open_connections(config, first, count):
+    """Open connections numbered first..first+count-1, each joined to its room"""
+    url = f"ws://127.0.0.1:{config['port']}"
+    rooms = config["rooms"]
+    limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def connect(i):
+        async with limit:
+            websocket = await websockets.connect(url, max_queue=None, ping_interval=None,
+                                                 open_timeout=60)
+            await websocket.send(f"/join room-{i % rooms}")
+            await websocket.recv()
+            return i, websocket
+
+    return await asyncio.gather(*(connect(i) for i in range(first, first + count)))
+
+
+async def hold_idle(config, first, count, go, results):
+    """Open `count` connections and keep them idle until the stop signal"""
+    connections = await open_connections(config, first, count)
+    results.put(("ready", None))
+    await asyncio.get_running_loop().run_in_executor(None, go.wait)
+    await asyncio.gather(*(ws.close() for _, ws in connections), return_exceptions=True)
+    results.put(("done", None))
+
+
+async def run_clients(config, first, count, go, results):
+    """Open `count` connections, wait for the start signal, then send and time messages"""
+    rooms = config["rooms"]
+    connections = await open_connections(config, first, count)
+    results.put(("ready", None))
+    await asyncio.get_running_loop().run_in_executor(None, go.wait)
+
+    start = time.time() + config["warmup"]
+    end = start + config["duration"]
+    padding = b"x" * max(0, config["size"] - TIMESTAMP.size)
+    interval = 1 / config["rate"] if config["rate"] else 0
+    sent = 0
+    latencies = array.array("d")
+
+    async def sender(websocket):
+        nonlocal sent
+        next_send = time.time()
+        while True:
+            now = time.time()
+            if now >= end:
+                return
+            await websocket.send(TIMESTAMP.pack(now) + padding)
+            if now >= start:
+                sent += 1
+            if interval:
+                next_send += interval
+                delay = next_send - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                await asyncio.sleep(0)  # send() rarely waits, so let the receivers run
+
+    async def receiver(websocket):
+        while True:
+            message = await websocket.recv()
+            now = time.time()
+            if start <= now < end and isinstance(message, bytes):
+                sent_at = TIMESTAMP.unpack_from(message)[0]
+                if sent_at >= start:
+                    latencies.append(now - sent_at)
+
+    tasks = [asyncio.create_task(receiver(ws)) for _, ws in connections]
+    tasks += [asyncio.create_task(sender(ws))
+              for i, ws in connections if i // rooms < config["senders"]]
+    await asyncio.sleep(end - time.time() + config["drain"])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.gather(*(ws.close() for _, ws in connections), return_exceptions=True)
+    results.put(("done", (sent, latencies)))
+
+
+def client_process(*args):
+    asyncio.run(run_clients(*args))
+
+
+def idle_process(*args):
+    asyncio.run(hold_idle(*args))
+
+
+def start_server(config, workers):
+    command = [sys.executable, SERVER, "--port", str(config["port"]),
+               "--workers", str(workers), "--default-room", ""]
+    command += shlex.split(config["server_args"])
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    wait_for_port(config["port"])
+    time.sleep(0.5)  # let every worker join the bus
+    return server
+
+
+def start_clients(config, target, go, results):
+    """Spread the clients over several processes and wait until all are connected"""
+    procs = config["procs"]
+    processes = []
+    for p in range(procs):
+        first = p * config["clients"] // procs
+        count = (p + 1) * config["clients"] // procs - first
+        processes.append(multiprocessing.Process(
+            target=target, args=(config, first, count, go, results)))
+    for process in processes:
+        process.start()
+    for _ in processes:
+        results.get()
+    return processes
+
+
+def measure_idle(config, workers):
+    """Server memory per idle connection"""
+    server = start_server(config, workers)
+    try:
+        time.sleep(IDLE_SETTLE)
+        empty = resource_usage(server.pid)
+        go = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = start_clients(config, idle_process, go, results)
+        time.sleep(IDLE_SETTLE)
+        loaded = resource_usage(server.pid)
+        go.set()
+        for _ in processes:
+            results.get()
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    result = {"workers": workers, "connections": config["clients"],
+              "server_rss_empty_bytes": None, "server_rss_loaded_bytes": None,
+              "bytes_per_connection": None}
+    if empty and loaded:
+        result.update(server_rss_empty_bytes=empty[0], server_rss_loaded_bytes=loaded[0],
+                      bytes_per_connection=(loaded[0] - empty[0]) / config["clients"])
+    return result
+
+
+def measure(config, workers):
+    """Run one benchmark against a fresh server with the given number of workers"""
+    server = start_server(config, workers)
+    try:
+        go = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = start_clients(config, client_process, go, results)
+
+        idle = resource_usage(server.pid)
+        go.set()
+        time.sleep(config["warmup"])
+        before = resource_usage(server.pid)
+        peak_rss = before[0] if before else None
+
+        # Sample the server while waiting for the client processes to report
+        sent = 0
+        latencies = []
+        after = None
+        pending = len(processes)
+        while pending:
+            try:
+                _, (s, values) = results.get(timeout=SAMPLE_INTERVAL)
+            except queue.Empty:
+                usage = resource_usage(server.pid)
+                # Samples after the measured window would include idle time
+                if usage and usage[2] <= before[2] + config["duration"]:
+                    after = usage
+                    peak_rss = max(peak_rss, usage[0])
+                continue
+            sent += s
+            latencies.extend(values)
+            pending -= 1
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    duration = config["duration"]
+    result = {
+        "workers": workers,
+        "sent_per_sec": sent / duration,
+        "delivered_per_sec": len(latencies) / duration,
+        "latency_ms": {
+            name: None if value is None else value * 1000
+            for name, value in (("p50", percentile(latencies, 0.50)),
+                                ("p99", percentile(latencies, 0.99)),
+                                ("p999", percentile(latencies, 0.999)),
+                                ("max", latencies[-1] if latencies else None))
+        },
+        "server_rss_idle_bytes": idle[0] if idle else None,
+        "server_rss_peak_bytes": peak_rss,
+        "server_cpu_percent": None,
+    }
+    if before and after:
+        result["server_cpu_percent"] = 100 * (after[1] - before[1]) / (after[2] - before[2])
+    return result
+
+
+def run_metadata():
+    """Enough context to compare result files across versions"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                cwd=os.path.dirname(SERVER), capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "websockets": websockets.__version__,
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator and fan-out latency benchmark for the chat server")
+    parser.add_argument("--workers", default="1",
+                        help="comma-separated worker counts to measure, e.g. 1,2,4,8")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--senders", type=int, default=1,
+                        help="clients per room that send (all clients receive)")
+    parser.add_argument("--rate", type=float, default=10,
+                        help="messages/sec per sender, 0 for as fast as possible")
+    parser.add_argument("--size", type=int, default=64, help="message size in bytes")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=1.0,
+                        help="seconds of load before measuring")
+    parser.add_argument("--drain", type=float, default=1.0,
+                        help="seconds to wait for in-flight messages after the window")
+    parser.add_argument("--procs", type=int, default=4,
+                        help="client processes generating load")
+    parser.add_argument("--server-args", default="",
+                        help='extra server options, e.g. "--raw --coalesce-ms 1"')
+    parser.add_argument("--idle", action="store_true",
+                        help="measure server memory per idle connection instead of load")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    config = {k: v for k, v in vars(args).items() if k not in ("workers", "output")}
+    runs = []
+    if args.idle:
+        print(f"{'workers':>7} {'clients':>8} {'empty MB':>9} {'loaded MB':>10} {'bytes/conn':>11}")
+        for workers in [int(w) for w in args.workers.split(",")]:
+            result = measure_idle(config, workers)
+            runs.append(result)
+            print(f"{workers:>7} {args.clients:>8} "
+                  f"{(result['server_rss_empty_bytes'] or 0) / 2**20:>9.1f} "
+                  f"{(result['server_rss_loaded_bytes'] or 0) / 2**20:>10.1f} "
+                  f"{result['bytes_per_connection'] or 0:>11.0f}")
+        write_results(args.output, config, runs)
+        return
+
+    print(f"{'workers':>7} {'sent/s':>10} {'delivered/s':>12} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'p999 ms':>8} {'RSS MB':>8} {'CPU %':>6}")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        result = measure(config, workers)
+        runs.append(result)
+        latency = result["latency_ms"]
+        rss = result["server_rss_peak_bytes"]
+        cpu = result["server_cpu_percent"]
+        print(f"{workers:>7} {result['sent_per_sec']:>10.0f} {result['delivered_per_sec']:>12.0f} "
+              f"{latency['p50'] or 0:>8.2f} {latency['p99'] or 0:>8.2f} {latency['p999'] or 0:>8.2f} "
+              f"{(rss or 0) / 2**20:>8.1f} {cpu or 0:>6.0f}")
+
+    write_results(args.output, config, runs)
+
+
+def write_results(path, config, runs):
+    if path:
+        with open(path, "w") as f:
+            json.dump({"meta": run_metadata(), "config": config, "runs": runs}, f, indent=2)
+        print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,938 @@
+import argparse
 import asyncio
+import bisect
+import collections
+import itertools
+import os
+import shutil
+import signal
+import struct
+import tempfile
+import time
+import zlib
+from http import HTTPStatus
 import websockets
+from websockets.asyncio.server import ServerConnection
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+from websockets.frames import Frame, Opcode
+from websockets.protocol import State
 
-connected_clients = set()
+# Server configuration
+HOST = "0.0.0.0"
+PORT = 8765
+QUEUE_SIZE = 256                  # Outgoing messages buffered per client
+SLOW_CONSUMER_POLICY = "drop_oldest"
+POLICIES = ("drop_oldest", "drop_newest", "disconnect")
+DEFAULT_ROOM = "lobby"            # Room every client joins on connect
+MAX_ROOM_NAME = 64
+COALESCE_DELAY = 0.0              # Seconds a writer may wait to batch more messages
+MAX_BATCH_BYTES = 64 * 1024       # Upper bound for one coalesced write
+COMPRESS_SETTINGS = {"memLevel": 5}  # Same zlib settings websockets uses by default
+METRICS_PATH = "/metrics"
+LAG_INTERVAL = 0.5                # Seconds between event-loop lag probes
+MESSAGE_RATE = 0                  # Messages/sec each client may send, 0 = unlimited
+BYTE_RATE = 0                     # Payload bytes/sec each client may send, 0 = unlimited
+BURST_SECONDS = 1.0               # Bucket size, in seconds of the sustained rate
+MAX_QUEUED_BYTES = 0              # Outgoing bytes queued for all clients, 0 = unlimited
+HISTORY_SIZE = 0                  # Messages kept per room for /resume, 0 = off
+HISTORY_BYTES = 1024 * 1024       # Payload bytes kept per room for /resume
 
-async def handle_client(*args):
-    websocket = args[0]
-    # Eğer path parametresi gelmişse, onu al; gelmemişse None yapıyoruz
-    path = args[1] if len(args) > 1 else None
-    
-    connected_clients.add(websocket)
+# High-density mode: small buffers and one shared keepalive timer
+DENSE_MAX_SIZE = 16 * 1024        # Largest incoming message
+DENSE_MAX_QUEUE = 4               # Incoming frames buffered before reading pauses
+DENSE_WRITE_LIMIT = 4096          # Transport write buffer high-water mark
+KEEPALIVE_INTERVAL = 20.0         # Seconds between keepalive sweeps
+KEEPALIVE_BATCH = 1000            # Pings sent before yielding to the event loop
+BUS_WRITE_LIMIT = 4 * 1024 * 1024  # Bytes buffered for a peer worker before messages are dropped
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Bus frame header: payload length, kind (0 text / 1 binary / 2 enveloped binary),
+# length of the room list
+BUS_HEADER = struct.Struct("!IBH")
+
+# Optional envelope at the start of a binary message in raw mode:
+# magic, version, room name length, reserved, sender id, sequence number
+ENVELOPE = struct.Struct("!BBBxIQ")
+ENVELOPE_SEQUENCE = struct.Struct("!Q")  # at offset 8, rewritten when history is on
+ENVELOPE_MAGIC = 0xCE
+ENVELOPE_VERSION = 1
+
+
+def frame_header(opcode, length, compressed=False):
+    """Header of an unmasked, unfragmented server frame carrying `length` bytes"""
+    first = 0x80 | opcode.value | (0x40 if compressed else 0)  # FIN, RSV1, opcode
+    if length < 126:
+        return struct.pack("!BB", first, length)
+    if length < 65536:
+        return struct.pack("!BBH", first, 126, length)
+    return struct.pack("!BBQ", first, 127, length)
+
+
+def parse_envelope(data):
+    """Return (sender id, room, sequence) for an enveloped binary message, else None"""
+    if len(data) < ENVELOPE.size or data[0] != ENVELOPE_MAGIC:
+        return None
+    _, version, room_length, sender_id, sequence = ENVELOPE.unpack_from(data)
+    end = ENVELOPE.size + room_length
+    if version != ENVELOPE_VERSION or len(data) < end:
+        return None
+    room = bytes(data[ENVELOPE.size:end]).decode("utf-8", errors="replace")
+    return sender_id, room, sequence
+
+
+class OutgoingMessage:
+    """A relayed message whose wire frame is built once and shared by every recipient"""
+
+    def __init__(self, data, text):
+        self.data = data    # UTF-8 or binary payload (bytes or memoryview)
+        self.text = text    # sent as a Text frame when True, Binary otherwise
+        self.frames = {}    # compression window bits (0 = none) -> (header, payload)
+        self.created = time.monotonic()
+        self.enveloped = False  # starts with a binary envelope (raw mode)
+
+    @classmethod
+    def from_message(cls, message):
+        if isinstance(message, str):
+            return cls(message.encode(), True)
+        return cls(message, False)
+
+    def stamp(self, sequence):
+        """Write the room's sequence number into the envelope before any frame is built"""
+        data = bytearray(self.data)
+        ENVELOPE_SEQUENCE.pack_into(data, 8, sequence)
+        self.data = data
+        self.frames.clear()
+
+    def frame(self, window_bits):
+        """Return the frame as (header, payload) buffers, compressing at most once per window size
+
+        Uncompressed frames reuse the payload buffer as is, so it is never copied.
+        """
+        frame = self.frames.get(window_bits)
+        if frame is None:
+            opcode = Opcode.TEXT if self.text else Opcode.BINARY
+            if window_bits:
+                # A fresh compressor never refers back to earlier messages, so the
+                # output is valid for every client whatever its context takeover
+                encoder = zlib.compressobj(wbits=-window_bits, **COMPRESS_SETTINGS)
+                data = encoder.compress(self.data) + encoder.flush(zlib.Z_SYNC_FLUSH)
+                data = memoryview(data)[:-4]
+                frame = (frame_header(opcode, len(data), compressed=True), data)
+            else:
+                frame = (frame_header(opcode, len(self.data)), self.data)
+            self.frames[window_bits] = frame
+        return frame
+
+
+def negotiated_window_bits(websocket):
+    """Window size of the server's permessage-deflate compressor, 0 when not negotiated"""
+    for extension in websocket.protocol.extensions:
+        if isinstance(extension, PerMessageDeflate):
+            return extension.local_max_window_bits or 15
+    return 0
+
+
+class RoomHistory:
+    """Ring buffer of a room's latest messages, numbered by a monotonic sequence"""
+
+    def __init__(self, max_messages, max_bytes):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.messages = collections.deque()  # OutgoingMessage, oldest first
+        self.sequence = 0                    # sequence number of the newest message
+        self.bytes = 0
+
+    def append(self, message):
+        """Store a message and return its sequence number"""
+        self.sequence += 1
+        self.messages.append(message)
+        self.bytes += len(message.data)
+        while (len(self.messages) > self.max_messages
+               or self.bytes > self.max_bytes and len(self.messages) > 1):
+            self.bytes -= len(self.messages.popleft().data)
+        return self.sequence
+
+    def since(self, sequence, until=None):
+        """Messages numbered after `sequence` and up to `until`, or None if some were already evicted"""
+        missing = self.sequence - sequence
+        if missing < 0 or missing > len(self.messages):
+            return None
+        start = len(self.messages) - missing
+        stop = len(self.messages) if until is None else start + max(0, until - sequence)
+        return list(itertools.islice(self.messages, start, stop))
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus exposition format"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels=""):
+        """Sample lines; `labels` is a label list such as 'worker="0"', added to every series"""
+        lines = []
+        total = 0
+        bucket_labels = labels + "," if labels else ""
+        labels = f"{{{labels}}}" if labels else ""
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{bucket_labels}le="{bound}"}} {total}')
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+
+class Metrics:
+    """Counters updated on the hot path and rendered on demand for /metrics"""
+
+    def __init__(self):
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+        self.writes = 0
+        self.dropped = 0        # messages discarded by drop_oldest / drop_newest
+        self.disconnected = 0   # clients closed by the disconnect policy
+        self.throttled = 0      # reads delayed by a client's rate limit
+        self.throttled_seconds = 0.0
+        self.over_budget = 0    # messages to clients over their share of the byte limit
+        self.queued_bytes = 0
+        self.send_seconds = Histogram()      # time spent writing and draining one batch
+        self.delivery_seconds = Histogram()  # time from relay to write, per batch
+        self.loop_lag_seconds = Histogram()
+        self.last_loop_lag = 0.0
+
+    def received(self, size):
+        self.messages_in += 1
+        self.bytes_in += size
+
+    async def watch_loop_lag(self, interval=LAG_INTERVAL):
+        """Measure how late the event loop wakes up a sleeping task"""
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            lag = max(0.0, time.monotonic() - started - interval)
+            self.last_loop_lag = lag
+            self.loop_lag_seconds.observe(lag)
+
+    def render(self, server):
+        """Prometheus text exposition of the counters and the server's current state"""
+        sessions = server.connected_clients
+        depths = [len(session.queue) for session in sessions]
+        metrics = [
+            ("chat_connected_clients", "gauge", "Connected WebSocket clients", len(sessions)),
+            ("chat_rooms", "gauge", "Rooms with at least one member", len(server.rooms)),
+            ("chat_messages_received_total", "counter", "Messages read from clients", self.messages_in),
+            ("chat_bytes_received_total", "counter", "Payload bytes read from clients", self.bytes_in),
+            ("chat_messages_sent_total", "counter", "Messages written to clients", self.messages_out),
+            ("chat_bytes_sent_total", "counter", "Frame bytes written to clients", self.bytes_out),
+            ("chat_writes_total", "counter", "Coalesced socket writes", self.writes),
+            ("chat_slow_consumer_drops_total", "counter", "Messages dropped for slow clients", self.dropped),
+            ("chat_slow_consumer_disconnects_total", "counter", "Clients disconnected for being slow",
+             self.disconnected),
+            ("chat_queued_messages", "gauge", "Messages waiting in client queues", sum(depths)),
+            ("chat_max_queue_depth", "gauge", "Longest client queue", max(depths, default=0)),
+            ("chat_queued_bytes", "gauge", "Payload bytes waiting in client queues",
+             self.queued_bytes),
+            ("chat_throttled_reads_total", "counter", "Reads delayed by a client rate limit",
+             self.throttled),
+            ("chat_throttled_seconds_total", "counter", "Time reads were delayed by rate limits",
+             self.throttled_seconds),
+            ("chat_over_budget_total", "counter",
+             "Messages to clients over their share of the outgoing byte limit", self.over_budget),
+            ("chat_event_loop_lag_seconds", "gauge", "Last measured event loop lag", self.last_loop_lag),
+        ]
+        lines = []
+        labels = ""
+        if server.bus is not None:
+            # Each scrape reaches one worker, so every series is labeled with it and
+            # Prometheus keeps one series per worker instead of seeing counter resets
+            labels = f'worker="{server.bus.worker_id}"'
+            lines += ["# HELP chat_worker_info Worker process that answered this scrape",
+                      "# TYPE chat_worker_info gauge",
+                      f"chat_worker_info{{{labels}}} 1"]
+            metrics.append(("chat_bus_drops_total", "counter",
+                            "Messages not sent to a worker that fell behind", server.bus.dropped))
+        series = f"{{{labels}}}" if labels else ""
+        for name, kind, help_text, value in metrics:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name}{series} {value}"]
+        for name, help_text, histogram in (
+                ("chat_send_seconds", "Time to write and drain one batch to a client",
+                 self.send_seconds),
+                ("chat_delivery_seconds", "Time from relay until the message is written",
+                 self.delivery_seconds),
+                ("chat_event_loop_lag_histogram_seconds", "Event loop lag samples",
+                 self.loop_lag_seconds)):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            lines += histogram.render(name, labels)
+        return "\n".join(lines) + "\n"
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second, holding at most `burst`"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self, amount):
+        """Take tokens; return how long to wait before the balance is positive again"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class OutboundBudget:
+    """Total payload bytes queued for all clients, with an optional limit
+
+    Over the limit, each client may hold only its share of the budget. The overflow
+    is charged to the clients holding more than that, never to the readers.
+    """
+
+    def __init__(self, limit, metrics):
+        self.limit = limit
+        self.metrics = metrics
+        self.clients = 0  # sessions sharing the budget
+
+    def add(self, size):
+        self.metrics.queued_bytes += size
+
+    def release(self, size):
+        self.metrics.queued_bytes -= size
+
+    def overdrawn(self, held, size):
+        """True when `size` more bytes pass the limit and the client would hold more than its share"""
+        if not self.limit or self.metrics.queued_bytes + size <= self.limit:
+            return False
+        return held + size > self.limit / max(1, self.clients)
+
+
+class ClientSession:
+    """Outgoing side of one connection: a bounded queue drained by a writer task
+
+    The writer task only exists while the queue has messages, and __slots__ keeps
+    the per-connection footprint small, so idle connections cost little memory.
+    """
+
+    __slots__ = ("websocket", "policy", "metrics", "budget", "message_bucket", "byte_bucket",
+                 "coalesce_delay", "max_batch", "window_bits", "queue", "queue_size",
+                 "queued_bytes", "rooms", "joined", "dropped", "closing", "writer", "blocked_since",
+                 "last_seen", "pong")
+
+    def __init__(self, websocket, queue_size, policy,
+                 coalesce_delay=COALESCE_DELAY, max_batch=MAX_BATCH_BYTES, metrics=None,
+                 budget=None, message_rate=MESSAGE_RATE, byte_rate=BYTE_RATE):
+        self.websocket = websocket
+        self.policy = policy
+        self.metrics = metrics or Metrics()
+        self.budget = budget or OutboundBudget(MAX_QUEUED_BYTES, self.metrics)
+        self.budget.clients += 1
+        # Read-side rate limits, None when unlimited
+        self.message_bucket = (TokenBucket(message_rate, message_rate * BURST_SECONDS)
+                               if message_rate else None)
+        self.byte_bucket = (TokenBucket(byte_rate, byte_rate * BURST_SECONDS)
+                            if byte_rate else None)
+        self.coalesce_delay = coalesce_delay
+        self.max_batch = max_batch
+        self.window_bits = negotiated_window_bits(websocket)
+        self.queue = collections.deque()  # OutgoingMessage waiting to be written
+        self.queue_size = queue_size
+        self.queued_bytes = 0  # payload bytes in the queue, charged to the budget
+        self.rooms = set()  # names of the rooms this client is subscribed to
+        self.joined = {}    # room -> its sequence number when joined, while history is on
+        self.dropped = 0
+        self.closing = False
+        self.writer = None  # running write_loop task, None while the queue is empty
+        self.blocked_since = None  # when the writer started waiting on a full socket
+        self.last_seen = time.monotonic()  # last message read from the client
+        self.pong = None    # pending keepalive ping in dense mode
+
+    def enqueue(self, message):
+        """Queue an OutgoingMessage without waiting; apply the slow-consumer policy when full
+
+        The queue is full when it holds queue_size messages, or when the process is
+        over its byte limit and this client holds more than its share.
+        """
+        if self.closing:
+            return False
+
+        size = len(message.data)
+        over_budget = self.budget.overdrawn(self.queued_bytes, size)
+        if over_budget:
+            self.metrics.over_budget += 1
+        if over_budget or len(self.queue) >= self.queue_size:
+            if self.policy == "drop_newest":
+                self.dropped += 1
+                self.metrics.dropped += 1
+                return False
+            if self.policy == "disconnect":
+                self.disconnect()
+                return False
+            # drop_oldest: make room by discarding the messages that waited longest
+            while self.queue and (len(self.queue) >= self.queue_size
+                                  or self.budget.overdrawn(self.queued_bytes, size)):
+                self.release(len(self.queue.popleft().data))
+                self.dropped += 1
+                self.metrics.dropped += 1
+
+        self.queue.append(message)
+        self.queued_bytes += size
+        self.budget.add(size)
+        if self.writer is None:
+            self.writer = asyncio.create_task(self.write_loop())
+        return True
+
+    def release(self, size):
+        """Return the bytes of messages leaving the queue to the budget"""
+        self.queued_bytes -= size
+        self.budget.release(size)
+
+    async def throttle(self, size):
+        """Charge one incoming message to the rate limits, sleeping off any deficit
+
+        While this sleeps nothing reads the socket, so the client is slowed down by
+        TCP flow control instead of the server buffering its messages.
+        """
+        self.last_seen = time.monotonic()
+        delay = 0.0
+        if self.message_bucket is not None:
+            delay = self.message_bucket.consume(1)
+        if self.byte_bucket is not None:
+            delay = max(delay, self.byte_bucket.consume(size))
+        if delay:
+            self.metrics.throttled += 1
+            self.metrics.throttled_seconds += delay
+            await asyncio.sleep(delay)
+
+    def reply(self, text):
+        """Queue a control reply for this client only"""
+        return self.enqueue(OutgoingMessage.from_message(text))
+
+    async def write_loop(self):
+        """Write queued frames in batches until the queue is empty
+
+        Only this client waits on its socket. Frames are written straight to the
+        transport, so every data message to this client must go through the queue.
+        """
+        websocket = self.websocket
+        metrics = self.metrics
+        queue = self.queue
+        try:
+            while queue:
+                if self.coalesce_delay:
+                    await asyncio.sleep(self.coalesce_delay)
+
+                # Everything queued by now goes out in a single write
+                message = queue.popleft()
+                created = message.created
+                header, payload = message.frame(self.window_bits)
+                buffers = [header, payload]
+                size = len(header) + len(payload)
+                queued = len(message.data)
+                while size < self.max_batch and queue:
+                    message = queue.popleft()
+                    header, payload = message.frame(self.window_bits)
+                    buffers += (header, payload)
+                    size += len(header) + len(payload)
+                    queued += len(message.data)
+                self.release(queued)
+
+                if websocket.protocol.state is not State.OPEN:
+                    self.closing = True
+                    break
+                started = time.monotonic()
+                websocket.transport.writelines(buffers)
+                self.blocked_since = started
+                await websocket.drain()
+                self.blocked_since = None
+                finished = time.monotonic()
+
+                metrics.writes += 1
+                metrics.messages_out += len(buffers) // 2
+                metrics.bytes_out += size
+                metrics.send_seconds.observe(finished - started)
+                metrics.delivery_seconds.observe(started - created)
+        except (websockets.exceptions.ConnectionClosed, ConnectionError):
+            self.closing = True
+        finally:
+            self.writer = None
+            self.blocked_since = None
+
+    def disconnect(self):
+        """Close a client that cannot keep up with its queue"""
+        if self.closing:
+            return
+        self.closing = True
+        self.metrics.disconnected += 1
+        asyncio.create_task(self.websocket.close(1008, "slow consumer"))
+
+    def close(self):
+        """Stop the writer task once the connection is gone"""
+        self.closing = True
+        if self.writer is not None:
+            self.writer.cancel()
+        while self.queue:
+            self.release(len(self.queue.popleft().data))
+        self.budget.clients -= 1
+
+
+class RelayConnection(ServerConnection):
+    """ServerConnection that remembers whether each incoming message was Text or Binary
+
+    recv(decode=False) returns bytes for both, so raw mode reads the kind from here.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.text_flags = collections.deque()  # one entry per message not read yet
+
+    def process_event(self, event):
+        if isinstance(event, Frame) and event.opcode in (Opcode.TEXT, Opcode.BINARY):
+            self.text_flags.append(event.opcode is Opcode.TEXT)
+        super().process_event(event)
+
+
+class LocalBus:
+    """Unix-socket mesh that carries relayed messages between worker processes"""
+
+    def __init__(self, path, worker_id, workers, on_message):
+        self.path = path
+        self.worker_id = worker_id
+        self.workers = workers
+        self.on_message = on_message  # called with (message, rooms) for remote messages
+        self.peers = []               # StreamWriter to every other worker
+        self.server = None
+        self.dropped = 0              # messages not sent to a worker that is not reading
+
+    def socket_path(self, worker_id):
+        return os.path.join(self.path, f"worker-{worker_id}.sock")
+
+    async def start(self):
+        """Listen for the other workers, then connect to each of them"""
+        self.server = await asyncio.start_unix_server(
+            self.read_loop, self.socket_path(self.worker_id))
+        for peer in range(self.workers):
+            if peer != self.worker_id:
+                self.peers.append(await self.connect(peer))
+
+    async def connect(self, peer):
+        """Connect to a peer worker, waiting until its socket exists"""
+        path = self.socket_path(peer)
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(path)
+                return writer
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.05)
+
+    def publish(self, rooms, message):
+        """Send an OutgoingMessage to every other worker; the frame is built once
+
+        Never waits: while a worker has BUS_WRITE_LIMIT bytes unread, messages for it
+        are dropped like drop_newest does for a slow client.
+        """
+        names = " ".join(rooms).encode()
+        kind = 0 if message.text else 2 if message.enveloped else 1
+        header = BUS_HEADER.pack(len(message.data), kind, len(names))
+        for writer in self.peers:
+            if writer.transport.get_write_buffer_size() >= BUS_WRITE_LIMIT:
+                self.dropped += 1
+                continue
+            writer.writelines((header, names, message.data))
+
+    async def read_loop(self, reader, writer):
+        """Deliver messages published by one peer worker"""
+        try:
+            while True:
+                length, kind, names_length = BUS_HEADER.unpack(
+                    await reader.readexactly(BUS_HEADER.size))
+                names = await reader.readexactly(names_length)
+                payload = await reader.readexactly(length)
+                message = OutgoingMessage(payload, kind == 0)
+                message.enveloped = kind == 2
+                self.on_message(message, names.decode().split(" "))
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+
+class ChatServer:
+    def __init__(self, queue_size=QUEUE_SIZE, policy=SLOW_CONSUMER_POLICY,
+                 default_room=DEFAULT_ROOM, coalesce_delay=COALESCE_DELAY,
+                 max_batch=MAX_BATCH_BYTES, raw=False, message_rate=MESSAGE_RATE,
+                 byte_rate=BYTE_RATE, max_queued_bytes=MAX_QUEUED_BYTES,
+                 history_size=HISTORY_SIZE, history_bytes=HISTORY_BYTES, dense=False):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy: {policy}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self.default_room = default_room
+        self.coalesce_delay = coalesce_delay
+        self.max_batch = max_batch
+        self.raw = raw                  # forward payloads as bytes, never decoding them
+        self.message_rate = message_rate
+        self.byte_rate = byte_rate
+        self.connected_clients = set()  # ClientSession objects
+        self.rooms = {}                 # room name -> set of ClientSession
+        self.history_size = history_size
+        self.history_bytes = history_bytes
+        self.histories = {}             # room name -> RoomHistory, while the room has members
+        self.dense = dense              # small buffers, shared keepalive, no compression
+        self.bus = None                 # LocalBus when running as one of several workers
+        self.metrics = Metrics()
+        self.budget = OutboundBudget(max_queued_bytes, self.metrics)
+
+    def join(self, session, room):
+        """Subscribe a client to a room, creating the room on first use"""
+        self.rooms.setdefault(room, set()).add(session)
+        if self.history_size and room not in session.rooms:
+            session.joined[room] = self.history(room).sequence
+        session.rooms.add(room)
+
+    def leave(self, session, room):
+        """Unsubscribe a client; empty rooms are dropped from the index"""
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(session)
+            if not members:
+                del self.rooms[room]
+                self.histories.pop(room, None)
+        session.rooms.discard(room)
+        session.joined.pop(room, None)
+
+    def history(self, room):
+        history = self.histories.get(room)
+        if history is None:
+            history = self.histories[room] = RoomHistory(self.history_size, self.history_bytes)
+        return history
+
+    def record(self, message, rooms):
+        """Number a message in each room's history; envelopes carry the number to clients"""
+        for room in rooms:
+            if room in self.rooms:
+                sequence = self.history(room).append(message)
+                if message.enveloped:
+                    message.stamp(sequence)
+
+    def broadcast(self, message, room, sender=None):
+        """Hand a message to every member of a room except the sender; never waits on a socket"""
+        for session in self.rooms.get(room, ()):
+            if session is not sender:
+                session.enqueue(message)
+
+    def deliver(self, message, rooms, sender=None):
+        """Send a message to the local members of the given rooms"""
+        if self.history_size:
+            self.record(message, rooms)
+        if len(rooms) == 1:
+            for room in rooms:
+                self.broadcast(message, room, sender)
+            return
+
+        # Several rooms: deliver once to clients sharing more than one
+        recipients = set()
+        for room in rooms:
+            recipients.update(self.rooms.get(room, ()))
+        recipients.discard(sender)
+        for session in recipients:
+            session.enqueue(message)
+
+    def relay(self, message, sender):
+        """Send a client's message to the rooms it is subscribed to, on every worker"""
+        if not sender.rooms:
+            return
+        self.deliver(message, sender.rooms, sender)
+        if self.bus is not None:
+            self.bus.publish(sender.rooms, message)
+
+    def route_envelope(self, message, sender, room):
+        """Relay an enveloped binary message to the room named in its header"""
+        if room not in sender.rooms:
+            sender.reply(f"/error not a member of {room}")
+            return
+        rooms = (room,)
+        self.deliver(message, rooms, sender)
+        if self.bus is not None:
+            self.bus.publish(rooms, message)
+
+    async def read_raw(self, session):
+        """Raw mode read loop: payloads stay bytes from the socket to every recipient"""
+        websocket = session.websocket
+        while True:
+            data = await websocket.recv(decode=False)
+            text = websocket.text_flags.popleft()
+            self.metrics.received(len(data))
+            await session.throttle(len(data))
+            if text:
+                # Recipients close the connection on invalid UTF-8, so only the sender is closed
+                try:
+                    decoded = data.decode()
+                except UnicodeDecodeError:
+                    await websocket.close(1007, "invalid UTF-8")
+                    return
+                if data[:1] == b"/":
+                    self.handle_command(session, decoded)
+                else:
+                    self.relay(OutgoingMessage(data, True), session)
+                continue
+
+            envelope = parse_envelope(data)
+            if envelope is None:
+                self.relay(OutgoingMessage(data, False), session)
+            else:
+                message = OutgoingMessage(data, False)
+                message.enveloped = True
+                self.route_envelope(message, session, envelope[1])
+
+    def resume(self, session, room, sequence):
+        """Join a room and replay the messages numbered after `sequence`
+
+        Replies /reset when the gap is no longer buffered or would not fit in the
+        client's queue; the client then has to resynchronize another way. Messages
+        relayed since the client joined, for example the default room on connect,
+        were already delivered live and are not replayed.
+        """
+        self.join(session, room)
+        history = self.history(room)
+        missed = history.since(sequence, session.joined[room])
+        free = session.queue_size - len(session.queue) - 1
+        if missed is None or len(missed) > free:
+            session.reply(f"/reset {room} {history.sequence}")
+            return
+        for message in missed:
+            session.enqueue(message)
+        session.reply(f"/resumed {room} {history.sequence}")
+
+    def handle_command(self, session, message):
+        """Process a control message: /join <room>, /leave <room> or /resume <room> <seq>"""
+        parts = message.split()
+        command = parts[0] if parts else ""
+        valid = (command in ("/join", "/leave") and len(parts) == 2
+                 or command == "/resume" and len(parts) == 3
+                 and parts[2].isascii() and parts[2].isdigit())
+        if not valid:
+            session.reply("/error usage: /join <room> | /leave <room> | /resume <room> <seq>")
+            return
+
+        room = parts[1]
+        if len(room) > MAX_ROOM_NAME:
+            session.reply(f"/error room name longer than {MAX_ROOM_NAME} characters")
+            return
+
+        if command == "/join":
+            self.join(session, room)
+            if self.history_size:
+                session.reply(f"/joined {room} {self.history(room).sequence}")
+            else:
+                session.reply(f"/joined {room}")
+        elif command == "/leave":
+            self.leave(session, room)
+            session.reply(f"/left {room}")
+        elif not self.history_size:
+            session.reply("/error history is disabled on this server")
+        else:
+            self.resume(session, room, int(parts[2]))
+
+    async def handle_client(self, *args):
+        websocket = args[0]
+        # Eğer path parametresi gelmişse, onu al; gelmemişse None yapıyoruz
+        path = args[1] if len(args) > 1 else None
+
+        session = ClientSession(websocket, self.queue_size, self.policy,
+                                self.coalesce_delay, self.max_batch, self.metrics,
+                                self.budget, self.message_rate, self.byte_rate)
+        self.connected_clients.add(session)
+        if self.default_room:
+            self.join(session, self.default_room)
+        try:
+            if self.raw:
+                await self.read_raw(session)
+            else:
+                async for message in websocket:
+                    if isinstance(message, str) and message.startswith("/"):
+                        size = len(message.encode())
+                        self.metrics.received(size)
+                        await session.throttle(size)
+                        self.handle_command(session, message)
+                    else:
+                        message = OutgoingMessage.from_message(message)
+                        self.metrics.received(len(message.data))
+                        await session.throttle(len(message.data))
+                        self.relay(message, session)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            for room in list(session.rooms):
+                self.leave(session, room)
+            self.connected_clients.discard(session)
+            session.close()
+
+    async def keepalive(self, interval=KEEPALIVE_INTERVAL):
+        """Dense mode: one timer pings idle clients instead of a task per connection
+
+        A client that has not answered the previous ping by the next sweep is closed.
+        Clients with a running writer are not pinged, so a full socket never blocks the
+        sweep; one whose writer has waited on the socket for a whole interval is aborted.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            idle_since = time.monotonic() - interval
+            for count, session in enumerate(list(self.connected_clients), 1):
+                if session.pong is not None and not session.pong.done():
+                    session.pong = None
+                    asyncio.create_task(session.websocket.close(1011, "keepalive ping timeout"))
+                elif session.blocked_since is not None and session.blocked_since < idle_since:
+                    # A close frame would wait behind the full buffer too, so drop the connection
+                    session.websocket.transport.abort()
+                elif session.last_seen < idle_since and session.writer is None:
+                    try:
+                        session.pong = await session.websocket.ping()
+                    except websockets.exceptions.ConnectionClosed:
+                        pass
+                if count % KEEPALIVE_BATCH == 0:
+                    await asyncio.sleep(0)
+
+    def process_request(self, connection, request):
+        """Answer plain HTTP requests for /metrics before the WebSocket handshake"""
+        if request.path.split("?", 1)[0] != METRICS_PATH:
+            return None  # continue with the WebSocket upgrade
+        response = connection.respond(HTTPStatus.OK, self.metrics.render(self))
+        response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        return response
+
+    async def start(self, host=HOST, port=PORT, bus=None):
+        asyncio.create_task(self.metrics.watch_loop_lag())
+        options = {"process_request": self.process_request}
+        if self.dense:
+            # No per-connection compressor, keepalive task or large buffers
+            options.update(compression=None, max_size=DENSE_MAX_SIZE,
+                           max_queue=DENSE_MAX_QUEUE, write_limit=DENSE_WRITE_LIMIT,
+                           ping_interval=None)
+            asyncio.create_task(self.keepalive())
+        if self.raw:
+            options["create_connection"] = RelayConnection
+        if bus is not None:
+            # Several workers share the port; the kernel spreads connections between them
+            self.bus = bus
+            if self.history_size:
+                # Each worker numbers a room's messages on its own, and a reconnecting
+                # client may land on any worker, where its sequence number means nothing
+                self.history_size = 0
+                if bus.worker_id == 0:
+                    print("History is not available with several workers, /resume is disabled")
+            await bus.start()
+            server = await websockets.serve(self.handle_client, host, port,
+                                            reuse_port=True, **options)
+            print(f"Sunucu çalışıyor: ws://localhost:{port} (worker {bus.worker_id})")
+        else:
+            server = await websockets.serve(self.handle_client, host, port, **options)
+            print(f"Sunucu çalışıyor: ws://localhost:{port}")
+        await server.wait_closed()
+
+
+def make_server(args):
+    return ChatServer(queue_size=args.queue_size, policy=args.policy,
+                      default_room=args.default_room,
+                      coalesce_delay=args.coalesce_ms / 1000,
+                      max_batch=args.max_batch_bytes, raw=args.raw,
+                      message_rate=args.message_rate, byte_rate=args.byte_rate,
+                      max_queued_bytes=args.max_queued_bytes,
+                      history_size=args.history, history_bytes=args.history_bytes,
+                      dense=args.dense)
+
+
+def run_workers(args):
+    """Fork one server process per worker, all listening on the same port"""
+    bus_dir = tempfile.mkdtemp(prefix="chat-bus-")
+    children = []
+    for worker_id in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server = make_server(args)
+                bus = LocalBus(bus_dir, worker_id, args.workers, server.deliver)
+                asyncio.run(server.start(args.host, args.port, bus=bus))
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    # Stop the workers on Ctrl+C as well as on SIGTERM
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     try:
-        async for message in websocket:
-            for client in connected_clients:
-                if client != websocket:
-                    await client.send(message)
-    except websockets.exceptions.ConnectionClosed:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
         pass
     finally:
-        connected_clients.remove(websocket)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        shutil.rmtree(bus_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WebSocket chat server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                        help="outgoing messages buffered per client")
+    parser.add_argument("--policy", choices=POLICIES, default=SLOW_CONSUMER_POLICY,
+                        help="what to do when a client's queue is full")
+    parser.add_argument("--default-room", default=DEFAULT_ROOM,
+                        help="room joined on connect (empty string for none)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes sharing the port (SO_REUSEPORT)")
+    parser.add_argument("--coalesce-ms", type=float, default=COALESCE_DELAY * 1000,
+                        help="latency budget for batching messages into one write")
+    parser.add_argument("--max-batch-bytes", type=int, default=MAX_BATCH_BYTES,
+                        help="largest coalesced write per client")
+    parser.add_argument("--raw", action="store_true",
+                        help="forward frames as bytes without decoding; route binary envelopes")
+    parser.add_argument("--message-rate", type=float, default=MESSAGE_RATE,
+                        help="messages/sec each client may send (0 = unlimited)")
+    parser.add_argument("--byte-rate", type=float, default=BYTE_RATE,
+                        help="payload bytes/sec each client may send (0 = unlimited)")
+    parser.add_argument("--max-queued-bytes", type=int, default=MAX_QUEUED_BYTES,
+                        help="outgoing bytes queued for all clients; over it, clients "
+                             "holding more than their share get the slow-consumer policy "
+                             "(0 = unlimited)")
+    parser.add_argument("--history", type=int, default=HISTORY_SIZE,
+                        help="messages kept per room for /resume (0 = off, always off "
+                             "with --workers)")
+    parser.add_argument("--history-bytes", type=int, default=HISTORY_BYTES,
+                        help="payload bytes kept per room for /resume")
+    parser.add_argument("--dense", action="store_true",
+                        help="high-density mode for many idle connections: small buffers, "
+                             "no compression, one shared keepalive timer")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        run_workers(args)
+        return
+
+    server = make_server(args)
+    asyncio.run(server.start(args.host, args.port))
 
-async def start_server():
-    server = await websockets.serve(handle_client, "0.0.0.0", 8765)
-    print("Sunucu çalışıyor: ws://localhost:8765")
-    await server.wait_closed()
 
-asyncio.run(start_server())
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+import argparse
+import array
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import time
+
+from udp_chat import UDPChat, WIRE_VERSION
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+POLL_INTERVAL = 0.01              # seconds between convergence checks
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(fraction * len(values)))
+    return values[index]
+
+
+async def run_peers(config, first, count, go, send, results):
+    """Run peers numbered first..first+count-1 in one event loop"""
+    total = config["peers"]
+    window = {"start": float("inf"), "end": 0.0}
+    received = 0
+    latencies = array.array("d")
+
+    def on_event(event):
+        nonlocal received
+        if event["type"] == "GENERAL" and window["start"] <= event["timestamp"] < window["end"]:
+            received += 1
+            latencies.append(time.time() - event["timestamp"])
+
+    peers = [UDPChat(f"peer{i}", config["multicast"], compress=config["compress"],
+                     reliable=config["reliable"], base_port=config["base_port"],
+                     port_range=max(total, 10), gossip=config["gossip"], on_event=on_event)
+             for i in range(first, first + count)]
+    results.put(("ready", None))
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, go.wait)
+
+    # Discovery: every peer should learn about every other peer
+    started = time.time()
+    opening = asyncio.gather(*(peer.open() for peer in peers))
+    converged = None
+    while time.time() - started < config["converge_timeout"]:
+        if all(len(peer.clients) == total - 1 for peer in peers):
+            converged = time.time() - started
+            break
+        await asyncio.sleep(POLL_INTERVAL)
+    await opening
+    results.put(("converged", converged))
+    await loop.run_in_executor(None, send.wait)
+
+    # Load: the first `senders` peers send general messages at a fixed rate
+    window["start"] = start = time.time() + config["warmup"]
+    window["end"] = end = start + config["duration"]
+    content = "x" * config["size"]
+    interval = 1 / config["rate"] if config["rate"] else 0
+    sent = 0
+
+    async def sender(peer):
+        nonlocal sent
+        next_send = time.time()
+        while True:
+            now = time.time()
+            if now >= end:
+                return
+            peer.send(content)
+            if now >= start:
+                sent += 1
+            if interval:
+                next_send += interval
+                delay = next_send - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                await asyncio.sleep(0)
+
+    tasks = [asyncio.create_task(sender(peer))
+             for i, peer in zip(range(first, first + count), peers) if i < config["senders"]]
+    await asyncio.sleep(max(0, start - time.time()))
+    datagrams = [(peer.datagrams_sent, peer.datagrams_received) for peer in peers]
+    await asyncio.sleep(max(0, end - time.time()))
+    datagrams = [(peer.datagrams_sent - tx, peer.datagrams_received - rx)
+                 for peer, (tx, rx) in zip(peers, datagrams)]
+    await asyncio.gather(*tasks)
+    await asyncio.sleep(config["drain"])
+
+    await asyncio.gather(*(peer.close(linger=0) for peer in peers))
+    results.put(("done", (sent, received, latencies, datagrams)))
+
+
+def peer_process(*args):
+    asyncio.run(run_peers(*args))
+
+
+def measure(config, total):
+    """Run one benchmark with `total` peers spread over the client processes"""
+    config = dict(config, peers=total)
+    go = multiprocessing.Event()
+    send = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    procs = min(config["procs"], total)
+    processes = []
+    for p in range(procs):
+        first = p * total // procs
+        count = (p + 1) * total // procs - first
+        processes.append(multiprocessing.Process(
+            target=peer_process, args=(config, first, count, go, send, results)))
+    for process in processes:
+        process.start()
+    for _ in processes:
+        results.get()
+
+    go.set()
+    converged = [results.get()[1] for _ in processes]
+    send.set()
+
+    sent = received = 0
+    latencies = []
+    datagrams = []
+    for _ in processes:
+        _, (s, r, lat, dgrams) = results.get()
+        sent += s
+        received += r
+        latencies.extend(lat)
+        datagrams.extend(dgrams)
+    for process in processes:
+        process.join()
+
+    latencies.sort()
+    duration = config["duration"]
+    expected = sent * (total - 1)
+    ms = lambda value: None if value is None else value * 1000
+    return {
+        "peers": total,
+        "converge_seconds": None if None in converged else max(converged),
+        "sent_per_second": sent / duration,
+        "delivered_per_second": received / duration,
+        "loss_rate": 1 - received / expected if expected else None,
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 0.50)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "p999": ms(percentile(latencies, 0.999)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        "datagrams_sent_per_peer_second": sum(tx for tx, _ in datagrams) / total / duration,
+        "datagrams_received_per_peer_second": sum(rx for _, rx in datagrams) / total / duration,
+    }
+
+
+def run_metadata():
+    """Enough context to compare result files across versions"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "wire_version": WIRE_VERSION,
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-peer UDP chat benchmark on loopback")
+    parser.add_argument("--peers", default="10",
+                        help="comma-separated peer counts to benchmark, e.g. 10,50,100")
+    parser.add_argument("--procs", type=int, default=2, help="processes running the peers")
+    parser.add_argument("--senders", type=int, default=2, help="peers sending messages")
+    parser.add_argument("--rate", type=float, default=10, help="messages per second per sender")
+    parser.add_argument("--size", type=int, default=100, help="message size in characters")
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds before measuring")
+    parser.add_argument("--drain", type=float, default=1, help="seconds to wait for late messages")
+    parser.add_argument("--converge-timeout", type=float, default=30,
+                        help="seconds to wait for discovery to converge")
+    parser.add_argument("--base-port", type=int, default=46000,
+                        help="first port of the range used by the peers")
+    parser.add_argument("--multicast", action="store_true")
+    parser.add_argument("--gossip", action="store_true")
+    parser.add_argument("--reliable", action="store_true")
+    parser.add_argument("--compress", action="store_true")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    config = {k: v for k, v in vars(args).items() if k not in ("peers", "output")}
+    runs = []
+    print(f"{'peers':>6} {'converge s':>10} {'sent/s':>8} {'deliv/s':>9} {'loss %':>7} "
+          f"{'p50 ms':>7} {'p99 ms':>7} {'p999 ms':>8} {'tx/peer/s':>10} {'rx/peer/s':>10}")
+    for total in [int(n) for n in args.peers.split(",")]:
+        result = measure(config, total)
+        runs.append(result)
+        latency = result["latency_ms"]
+        converge = result["converge_seconds"]
+        print(f"{total:>6} {'-' if converge is None else f'{converge:.2f}':>10} "
+              f"{result['sent_per_second']:>8.0f} {result['delivered_per_second']:>9.0f} "
+              f"{(result['loss_rate'] or 0) * 100:>7.2f} "
+              f"{latency['p50'] or 0:>7.2f} {latency['p99'] or 0:>7.2f} {latency['p999'] or 0:>8.2f} "
+              f"{result['datagrams_sent_per_peer_second']:>10.1f} "
+              f"{result['datagrams_received_per_peer_second']:>10.1f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": run_metadata(), "config": config, "runs": runs}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
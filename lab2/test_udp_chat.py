@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Loopback checks for udp_chat.py, run with: python -m pytest lab2"""
+import asyncio
+import errno
+import time
+
+import udp_chat
+from udp_chat import UDPChat
+
+BASE_PORT = 47500  # Away from the default range, so running chats do not interfere
+
+
+async def start_pair(**options):
+    """Two chats that know each other, and the events the second one receives"""
+    events = []
+    alice = UDPChat("alice", base_port=BASE_PORT, port_range=2, **options)
+    bob = UDPChat("bob", base_port=BASE_PORT, port_range=2, on_event=events.append, **options)
+    await asyncio.gather(alice.open(), bob.open())
+    return alice, bob, events
+
+
+async def wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        await asyncio.sleep(0.05)
+    return condition()
+
+
+def test_reliable_delivery_continues_after_a_message_is_given_up(monkeypatch):
+    monkeypatch.setattr(udp_chat, 'MAX_RETRIES', 2)
+
+    async def run():
+        alice, bob, events = await start_pair(reliable=True)
+        undelivered = []
+        alice.on_event = lambda event: undelivered.append(event) if event['type'] == 'UNDELIVERED' else None
+
+        # Every transmission of "two" is lost
+        send_to = alice.send_to
+        alice.send_to = lambda datagrams, port: send_to(
+            [data for data in datagrams if b'two' not in data], port)
+        for content in ("one", "two", "three", "four", "five"):
+            alice.send(content, "bob")
+
+        received = lambda: [event['content'] for event in events if event['type'] == 'PRIVATE']
+        await wait_for(lambda: "five" in received(), 10)
+        await asyncio.gather(alice.close(linger=0), bob.close(linger=0))
+        return received(), undelivered
+
+    received, undelivered = asyncio.run(run())
+    assert received == ["one", "three", "four", "five"]
+    assert len(undelivered) == 1
+
+
+def test_a_skip_far_ahead_is_handled_at_once():
+    async def run():
+        alice, bob, events = await start_pair(reliable=True)
+        alice.send("one", "bob")
+        await wait_for(lambda: "alice" in bob.channels, 5)
+        started = time.monotonic()
+        bob.skip_to("alice", 0xFFFFFFFF)
+        seconds = time.monotonic() - started
+        await asyncio.gather(alice.close(linger=0), bob.close(linger=0))
+        return seconds
+
+    assert asyncio.run(run()) < 0.1
+
+
+def test_gossip_does_not_bring_back_a_user_who_left():
+    async def run():
+        alice, bob, events = await start_pair(gossip=True)
+        await wait_for(lambda: "alice" in bob.clients, 5)
+        port = alice.port
+        await alice.close(linger=0.1)
+        left = any(event['type'] == 'LEAVE' for event in events)
+
+        # Gossip sent before the BYE arrives afterwards
+        bob.merge_gossip([["alice", port, udp_chat.ALIVE, 0, udp_chat.WIRE_VERSION]])
+        known = "alice" in bob.clients
+        await bob.close(linger=0)
+        return left, known
+
+    left, known = asyncio.run(run())
+    assert left
+    assert not known
+
+
+class FlakySocket:
+    """Socket whose sendmsg() calls fail with the given errors, in order"""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.sent = []
+
+    def sendmsg(self, buffers, ancillary, flags, address):
+        error = self.errors.pop(0) if self.errors else None
+        if error is not None:
+            raise OSError(error, "sendmsg failed")
+        self.sent.append(b''.join(buffers))
+
+    def sendto(self, data, address):
+        self.sent.append(data)
+
+
+def test_gso_stays_on_when_the_buffer_is_full_and_resumes_after_the_failed_batch(monkeypatch):
+    monkeypatch.setattr(udp_chat, 'GSO_MAX_SEGMENTS', 2)
+    chat = UDPChat("alice", base_port=BASE_PORT, port_range=2)
+    chat.socket.close()
+    datagrams = [bytes([n]) * 4 for n in range(6)]
+
+    chat.gso = True
+    chat.socket = FlakySocket([errno.EAGAIN])
+    chat.send_datagrams(datagrams, ('127.0.0.1', BASE_PORT))
+    assert chat.gso
+    assert chat.socket.sent == [datagrams[2] + datagrams[3], datagrams[4] + datagrams[5]]
+
+    chat.socket = FlakySocket([None, errno.EINVAL])
+    chat.send_datagrams(datagrams, ('127.0.0.1', BASE_PORT))
+    assert not chat.gso
+    assert chat.socket.sent == [datagrams[0] + datagrams[1]] + datagrams[2:]
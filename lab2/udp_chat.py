@@ -1,34 +1,388 @@
 #!/usr/bin/env python3
+import asyncio
+import errno
 import socket
 import threading
 import sys
+import argparse
 import json
 import time
+import math
+import heapq
 import random
+import struct
+import zlib
+from collections import OrderedDict, deque
 
 # Connection configuration
 LOCAL_IP = '127.0.0.1'    # Localhost address
-BASE_PORT = 45000         # Base port
-PORT_RANGE = 10           # Using ports 45000-45009
-BUFFER_SIZE = 2048        # Buffer size
+BASE_PORT = 45000         # Default base port
+PORT_RANGE = 10           # Default range: ports 45000-45009
+BUFFER_SIZE = 65535       # Largest UDP datagram
+READ_BATCH = 64           # Datagrams handled per socket wakeup
+DEFAULT_RCVBUF = 1 << 20  # Room for bursts of fragments (capped by the kernel)
+
+# Timers
+HEARTBEAT_INTERVAL = 5    # Seconds between heartbeats
+INACTIVE_TIMEOUT = 30     # Seconds without activity before a user is removed
+ACK_DELAY = 0.1           # Longest random delay before answering HELLOs, which batches joins
+HELLO_WINDOW = 2          # Seconds in which repeated HELLOs from a user get one answer
+
+# Multicast configuration
+MULTICAST_GROUP = '239.255.45.0'  # Administratively scoped group
+MULTICAST_PORT = 45100            # Port shared by all group members
+MULTICAST_TTL = 1                 # Do not leave the local network
+GROUP_TYPES = ('GENERAL', 'HEARTBEAT', 'HELLO', 'BYE')  # Sent to every peer
+
+# Wire format
+# Version 0 is the original JSON object. Version 1 is a binary header
+# (magic, version, type, flags, sender id, port, sequence, timestamp)
+# followed by the sender, recipient and content as length-prefixed UTF-8.
+# Version 2 peers also accept fragments: (magic, flags, index, count,
+# message id) followed by a slice of an encoded, possibly compressed message.
+# Version 3 peers acknowledge reliable messages (flag 0x01) with ACK messages,
+# and a SKIP tells the receiver to stop waiting for messages that were given up.
+# Version 4 adds gossip probes and an optional length-prefixed JSON list of
+# membership updates after the content.
+WIRE_VERSION = 4
+WIRE_MAGIC = 0xC7
+WIRE_HEADER = struct.Struct('!BBBBIHId')
+FRAGMENT_MAGIC = 0xC8
+FRAGMENT_HEADER = struct.Struct('!BBHHI')
+FRAGMENT_COMPRESSED = 0x01
+FRAGMENT_SIZE = 1400      # Payload bytes per fragment, fits an Ethernet MTU
+MAX_FRAGMENTS = 512       # Largest message: about 700 KB after compression
+MAX_PARTIAL = 64          # Messages being reassembled at the same time
+REASSEMBLY_TIMEOUT = 5    # Seconds to wait for the missing fragments
+COMPRESS_THRESHOLD = 1024 # Compress messages larger than this (with --compress)
+
+# Reliable delivery (with --reliable)
+RELIABLE_FLAG = 0x01
+RELIABLE_TYPES = ('GENERAL', 'PRIVATE')
+RELIABLE_WINDOW = 64      # Messages in flight per peer
+MAX_RETRIES = 8           # Retransmissions before a message is given up
+INITIAL_RTO = 1.0         # Retransmission timeout before the first RTT sample
+MIN_RTO = 0.2
+MAX_RTO = 5.0
+DELAYED_ACK = 0.02        # ACKs for in-order messages are batched this long
+MAX_SACK_BLOCKS = 16      # Ranges of out-of-order messages reported per ACK
+
+# Gossip membership (with --gossip)
+GOSSIP_INTERVAL = 1.0     # Protocol period: one member is probed per period
+PING_TIMEOUT = 0.3        # Wait for a direct PING_ACK before asking others
+INDIRECT_PROBES = 3       # Members asked to probe a member that did not answer
+SUSPICION_MULTIPLIER = 5  # Suspicion lasts this many periods times log10(group size)
+RETRANSMIT_MULTIPLIER = 3 # Each update is piggybacked this many times log2(group size)
+MAX_PIGGYBACK = 6         # Membership updates carried per message
+MAX_JOIN_MEMBERS = 32     # Members listed in the HELLO_ACK to a new user
+DEAD_RETENTION = 60       # Seconds a removed member's incarnation is remembered
+ALIVE, SUSPECT, DEAD = 'alive', 'suspect', 'dead'
+
+# Linux UDP generic segmentation offload: one sendmsg() for many fragments
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_BYTES = 65000
+GSO_UNSUPPORTED = (errno.EINVAL, errno.ENOPROTOOPT, errno.EIO)  # Kernel or device lacks GSO
+MESSAGE_TYPES = ('HELLO', 'HELLO_ACK', 'GENERAL', 'PRIVATE', 'HEARTBEAT', 'BYE', 'ACK',
+                 'PING', 'PING_REQ', 'PING_ACK', 'SKIP')
+TYPE_CODES = {name: code for code, name in enumerate(MESSAGE_TYPES)}
+REQUIRED_FIELDS = ('type', 'sender', 'sender_port', 'recipient', 'content')
+
+
+def encode_message(message, version):
+    """Serialize a message dict in the given wire version"""
+    if version >= 1:
+        sender = message['sender'].encode('utf-8')
+        recipient = message['recipient'].encode('utf-8')
+        content = message['content'].encode('utf-8')
+        if len(sender) < 256 and len(recipient) < 256 and len(content) < 65536:
+            flags = RELIABLE_FLAG if message.get('reliable') else 0
+            header = WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, TYPE_CODES[message['type']], flags,
+                                      message['sender_id'], message['sender_port'],
+                                      message['sequence'], message['timestamp'])
+            # Older versions stop reading after the content, so the gossip can follow it
+            gossip = json.dumps(message['gossip']).encode('utf-8') if message.get('gossip') else b''
+            return b''.join((header, bytes((len(sender),)), sender, bytes((len(recipient),)), recipient,
+                             len(content).to_bytes(2, 'big'), content,
+                             len(gossip).to_bytes(2, 'big') if gossip else b'', gossip))
+    # Version 0, or strings too long for the binary length prefixes
+    return json.dumps(message).encode('utf-8')
+
+
+def decode_message(data):
+    """Parse a datagram in either wire version, None if it is malformed"""
+    try:
+        if data[0] == WIRE_MAGIC:
+            _, version, code, flags, sender_id, port, sequence, timestamp = WIRE_HEADER.unpack_from(data)
+            offset = WIRE_HEADER.size
+            fields = []
+            for width in (1, 1, 2):
+                length = int.from_bytes(data[offset:offset + width], 'big')
+                offset += width
+                fields.append(data[offset:offset + length].decode('utf-8'))
+                offset += length
+            if offset > len(data):
+                return None
+            sender, recipient, content = fields
+            message = {'type': MESSAGE_TYPES[code], 'sender': sender, 'sender_id': sender_id,
+                       'sender_port': port, 'recipient': recipient, 'content': content,
+                       'timestamp': timestamp, 'sequence': sequence, 'version': version,
+                       'reliable': bool(flags & RELIABLE_FLAG)}
+            if offset < len(data):
+                length = int.from_bytes(data[offset:offset + 2], 'big')
+                message['gossip'] = json.loads(data[offset + 2:offset + 2 + length])
+            return message
+        
+        message = json.loads(data.decode('utf-8'))
+        if not all(field in message for field in REQUIRED_FIELDS):
+            return None
+        return message
+    except (ValueError, IndexError, struct.error):
+        return None
+
+
+def fragment_message(data, message_id, compress):
+    """Split an encoded message into fragment datagrams"""
+    flags = 0
+    if compress and len(data) > COMPRESS_THRESHOLD:
+        packed = zlib.compress(data)
+        if len(packed) < len(data):
+            data = packed
+            flags |= FRAGMENT_COMPRESSED
+    count = max(1, -(-len(data) // FRAGMENT_SIZE))
+    if count > MAX_FRAGMENTS:
+        raise ValueError(f"message too large ({len(data)} bytes)")
+    return [FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, flags, index, count, message_id)
+            + data[index * FRAGMENT_SIZE:(index + 1) * FRAGMENT_SIZE]
+            for index in range(count)]
+
+
+class PartialMessage:
+    """Fragments received so far for one message"""
+    
+    __slots__ = ('flags', 'chunks', 'missing', 'timer')
+    
+    def __init__(self, flags, count, timer):
+        self.flags = flags
+        self.chunks = [None] * count
+        self.missing = count
+        self.timer = timer
+
+def parse_sack(content):
+    """Ranges from an ACK's content, e.g. "5-7,9" -> [(5, 7), (9, 9)]"""
+    ranges = []
+    for block in filter(None, content.split(',')):
+        low, _, high = block.partition('-')
+        ranges.append((int(low), int(high or low)))
+    return ranges
+
+
+class PeerChannel:
+    """Reliable delivery state for one peer, in both directions"""
+    
+    __slots__ = ('session', 'next_seq', 'unacked', 'backlog', 'srtt', 'rttvar', 'rto',
+                 'retransmit_timer', 'skip', 'expected', 'received', 'ack_timer')
+    
+    def __init__(self, session):
+        self.session = session          # Peer's sender id, changes when it restarts
+        # Sending
+        self.next_seq = 1
+        self.unacked = {}               # seq -> [datagrams, sent_time, retries], oldest first
+        self.backlog = deque()          # (type, content, recipient) waiting for the window
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.retransmit_timer = None
+        self.skip = 0                   # Highest given-up seq, until the receiver acknowledges it
+        # Receiving
+        self.expected = 1               # Next in-order seq
+        self.received = {}              # seq -> message, received out of order
+        self.ack_timer = None
+    
+    def cancel(self):
+        for timer in (self.retransmit_timer, self.ack_timer):
+            if timer is not None:
+                timer.cancel()
+
+
+class Peer:
+    """A known user"""
+    
+    __slots__ = ('username', 'port', 'last_seen', 'version')
+    
+    def __init__(self, username, port, last_seen, version):
+        self.username = username
+        self.port = port
+        self.last_seen = last_seen
+        self.version = version
+
+
+class PeerTable:
+    """Known users, indexed by name and by port, safe to read from any thread
+    
+    Writers hold a lock. Readers iterate over snapshot(), an immutable tuple
+    that is only rebuilt after users join, leave or change port.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._peers = OrderedDict()  # username -> Peer, least recently seen first
+        self._by_port = {}           # port -> Peer
+        self._versions = {}          # wire version -> number of peers using it
+        self._snapshot = ()
+        self._stale = False
+    
+    def __len__(self):
+        return len(self._peers)
+    
+    def __contains__(self, username):
+        return username in self._peers
+    
+    def __getitem__(self, username):
+        return self._peers[username]
+    
+    def __iter__(self):
+        return iter(self.snapshot())
+    
+    def get(self, username):
+        return self._peers.get(username)
+    
+    def by_port(self, port):
+        return self._by_port.get(port)
+    
+    def touch(self, username, port, version, now):
+        """Record activity from a user, returns (is_new, displaced username or None)"""
+        with self._lock:
+            displaced = None
+            owner = self._by_port.get(port)
+            if owner is not None and owner.username != username:
+                # A port has one owner at a time, so the previous one has gone
+                self._remove(owner.username)
+                displaced = owner.username
+            
+            peer = self._peers.get(username)
+            if peer is None:
+                peer = self._peers[username] = Peer(username, port, now, version)
+                self._by_port[port] = peer
+                self._count(version, 1)
+                self._stale = True
+                return True, displaced
+            
+            self._peers.move_to_end(username)
+            peer.last_seen = now
+            if peer.port != port:
+                if self._by_port.get(peer.port) is peer:
+                    del self._by_port[peer.port]
+                self._by_port[port] = peer
+                peer.port = port
+                self._stale = True
+            if peer.version != version:
+                self._count(peer.version, -1)
+                self._count(version, 1)
+                peer.version = version
+            return False, displaced
+    
+    def remove(self, username):
+        with self._lock:
+            return self._remove(username)
+    
+    def _remove(self, username):
+        peer = self._peers.pop(username, None)
+        if peer is not None:
+            if self._by_port.get(peer.port) is peer:
+                del self._by_port[peer.port]
+            self._count(peer.version, -1)
+            self._stale = True
+        return peer
+    
+    def _count(self, version, change):
+        count = self._versions.get(version, 0) + change
+        if count:
+            self._versions[version] = count
+        else:
+            del self._versions[version]
+    
+    def oldest(self):
+        """The least recently seen user, None if there is nobody"""
+        with self._lock:
+            return next(iter(self._peers.values()), None)
+    
+    def min_version(self):
+        with self._lock:
+            return min(self._versions)
+    
+    def snapshot(self):
+        """All users as a tuple that later changes do not affect"""
+        if self._stale:
+            with self._lock:
+                if self._stale:
+                    self._snapshot = tuple(self._peers.values())
+                    self._stale = False
+        return self._snapshot
+
 
 class UDPChat:
-    def __init__(self, username):
+    def __init__(self, username, multicast=False, wire_version=WIRE_VERSION,
+                 compress=False, rcvbuf=DEFAULT_RCVBUF, sndbuf=None, reliable=False,
+                 base_port=BASE_PORT, port_range=PORT_RANGE, gossip=False, on_event=None):
         self.username = username
+        self.sender_id = random.getrandbits(32)  # Identifies this session
+        self.reliable = reliable
+        self.channels = {}  # username -> PeerChannel, for peers of wire version 3
         self.running = True
-        self.clients = {}  # username -> [port, last_seen_time]
+        self.multicast = multicast
+        self.wire_version = wire_version
+        self.compress = compress
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.sequence = 0
+        self.message_id = 0
+        self.partial = {}  # (address, message id) -> PartialMessage
+        self.gso = sys.platform.startswith('linux')
+        self.base_port = base_port
+        self.port_range = port_range
+        self.clients = PeerTable()
+        self.hellos_pending = {}             # (username, port) of HELLOs to answer
+        self.hellos_answered = OrderedDict()  # (username, port) -> time answered, oldest first
+        self.hello_timer = None
+        # Gossip membership
+        self.gossip = gossip
+        self.incarnation = 0     # Raised to refute suspicion about ourselves
+        self.members = {}        # username -> [state, incarnation]
+        self.updates = {}        # username -> [update, transmissions left]
+        self.suspicions = {}     # username -> timer that declares it dead
+        self.tombstones = {}     # username -> incarnation it was removed at
+        self.probe_order = []    # Members left to probe in this round
+        self.probe = None        # [target, sequence, acknowledged]
+        self.probe_seq = 0
+        self.relays = {}         # sequence -> (requester port, requester sequence)
+        self.gossip_timer = None
+        self.loop = None
+        self.sockets = []        # Sockets watched by the event loop
+        self.events = None       # Events waiting for messages(), unless on_event is set
+        self.on_event = on_event
+        self.datagrams_sent = 0
+        self.datagrams_received = 0
+        self.heartbeat_timer = None
+        self.expiry_timer = None
         self.setup_socket()
+        if multicast:
+            self.setup_multicast()
         
     def setup_socket(self):
         """Configure the UDP socket"""
         try:
             # Create a UDP socket
+            # No SO_REUSEADDR: each peer needs a port of its own for unicast
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.set_buffers(self.socket)
             
-            # Try to bind to an available port from the range
+            # Try to bind to an available port from the range, starting at a
+            # random offset so that large groups do not all probe the same ports
             port_assigned = False
-            for port in range(BASE_PORT, BASE_PORT + PORT_RANGE):
+            start = random.randrange(self.port_range)
+            for offset in range(self.port_range):
+                port = self.base_port + (start + offset) % self.port_range
                 try:
                     self.socket.bind((LOCAL_IP, port))
                     self.port = port
@@ -36,169 +390,922 @@ class UDPChat:
                     break
                 except OSError:
                     continue
-                    
+            
+            if not port_assigned and self.multicast:
+                # Peers learn each other's ports from the group, so any port works
+                self.socket.bind((LOCAL_IP, 0))
+                self.port = self.socket.getsockname()[1]
+                port_assigned = True
+            
             if not port_assigned:
-                print("Could not find an available port. Please try again.")
-                sys.exit(1)
-                
-            print(f"Chat successfully initialized on port {self.port}")
-        except Exception as e:
-            print(f"Error configuring socket: {e}")
-            sys.exit(1)
+                raise OSError("Could not find an available port. Please try again.")
+        except OSError as e:
+            self.socket.close()
+            raise OSError(f"Error configuring socket: {e}") from e
     
-    def broadcast_message(self, data):
+    def setup_multicast(self):
+        """Join the multicast group used for messages to all peers"""
+        try:
+            # Outgoing group messages leave through the unicast socket
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(LOCAL_IP))
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            
+            # Every peer binds the same group port to receive group messages
+            self.group_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.group_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.set_buffers(self.group_socket)
+            self.group_socket.bind(('', MULTICAST_PORT))
+            membership = socket.inet_aton(MULTICAST_GROUP) + socket.inet_aton(LOCAL_IP)
+            self.group_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError as e:
+            self.socket.close()
+            raise OSError(f"Error configuring multicast: {e}") from e
+    
+    def set_buffers(self, sock):
+        """Apply the requested kernel buffer sizes"""
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+    
+    def send_datagrams(self, datagrams, address):
+        """Send datagrams to one address, several per system call where supported"""
+        start = 0
+        if self.gso and len(datagrams) > 1:
+            # Every fragment but the last has the same size, as GSO requires
+            size = len(datagrams[0])
+            batch = max(1, min(GSO_MAX_SEGMENTS, GSO_MAX_BYTES // size))
+            segment = struct.pack('=H', size)
+            while start < len(datagrams):
+                chunk = datagrams[start:start + batch]
+                try:
+                    self.socket.sendmsg([b''.join(chunk)],
+                                        [(socket.IPPROTO_UDP, UDP_SEGMENT, segment)], 0, address)
+                    self.datagrams_sent += len(chunk)
+                except OSError as e:
+                    if e.errno in GSO_UNSUPPORTED:
+                        self.gso = False  # Not supported here, send the rest one by one
+                        break
+                    # Kernel buffer full or peer unreachable: drop, as the network would
+                start += batch
+        for data in datagrams[start:]:
+            try:
+                self.socket.sendto(data, address)
+                self.datagrams_sent += 1
+            except (BlockingIOError, InterruptedError):
+                pass  # Kernel buffer full: drop, as the network would
+            except OSError:
+                pass
+    
+    def send_to(self, datagrams, port):
+        """Send the message to a single peer"""
+        self.send_datagrams(datagrams, (LOCAL_IP, port))
+    
+    def broadcast_message(self, datagrams):
         """Send the message to all ports in the range"""
-        for port in range(BASE_PORT, BASE_PORT + PORT_RANGE):
+        for port in range(self.base_port, self.base_port + self.port_range):
             if port != self.port:  # Don't send to self
-                try:
-                    self.socket.sendto(data, (LOCAL_IP, port))
-                except:
-                    pass
+                self.send_datagrams(datagrams, (LOCAL_IP, port))
+    
+    def peer_version(self, recipient):
+        """Wire version to use for a message to this recipient"""
+        peer = self.clients.get(recipient)
+        if peer is not None:
+            return min(self.wire_version, peer.version)
+        if recipient == "ALL" and self.clients:
+            # One datagram reaches everybody, so every peer must understand it
+            return min(self.wire_version, self.clients.min_version())
+        return 0
+    
+    def update_client(self, username, port, version):
+        """Record activity from a user and report joins"""
+        is_new, displaced = self.clients.touch(username, port, version, time.time())
+        if displaced is not None:
+            self.remove_client(displaced)
+            self.emit('LEAVE', displaced)
+        if is_new:
+            self.emit('JOIN', username, port=port)
     
-    def send_message(self, message_type, content, recipient="ALL"):
-        """Create and send a message"""
+    def remove_client(self, username):
+        self.clients.remove(username)
+        self.close_channel(username)
+        self.members.pop(username, None)
+        suspicion = self.suspicions.pop(username, None)
+        if suspicion is not None:
+            suspicion.cancel()
+
+    
+    def build_message(self, message_type, content, recipient, sequence=None, reliable=False):
+        """Create the message structure"""
+        if sequence is None:
+            self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+            sequence = self.sequence
+        
+        message = {
+            'type': message_type,
+            'sender': self.username,
+            'sender_id': self.sender_id,
+            'sender_port': self.port,
+            'recipient': recipient,
+            'content': content,
+            'timestamp': time.time(),
+            'sequence': sequence,
+            'version': self.wire_version
+        }
+        if reliable:
+            message['reliable'] = True
+        if self.gossip:
+            message['gossip'] = self.piggyback()
+        return message
+    
+    def encode_datagrams(self, message, version):
+        """Encode a message as one datagram, or as fragments if it is large"""
+        data = encode_message(message, version)
+        
+        # Large messages are fragmented for peers that can reassemble them
+        if version >= 2 and (len(data) > FRAGMENT_SIZE or (self.compress and len(data) > COMPRESS_THRESHOLD)):
+            self.message_id = (self.message_id + 1) & 0xFFFFFFFF
+            return fragment_message(data, self.message_id, self.compress)
+        return [data]
+    
+    def send_message(self, message_type, content, recipient="ALL", port=None):
+        """Create and send a message, to a single port if given"""
         try:
-            # Create message structure
-            message = {
-                'type': message_type,
-                'sender': self.username,
-                'sender_port': self.port,
-                'recipient': recipient,
-                'content': content,
-                'timestamp': time.time()
-            }
-            
-            # Encode message as JSON
-            data = json.dumps(message).encode('utf-8')
-            
-            # Send message to all ports
-            self.broadcast_message(data)
+            if self.reliable and message_type in RELIABLE_TYPES:
+                self.send_reliable(message_type, content, recipient)
+                return True
+            
+            message = self.build_message(message_type, content, recipient)
+            
+            # HELLO stays JSON so that peers we do not know yet can read it
+            version = 0 if message_type == 'HELLO' else self.peer_version(recipient)
+            datagrams = self.encode_datagrams(message, version)
+            
+            if port is not None:
+                self.send_to(datagrams, port)
+            elif self.multicast and message_type in GROUP_TYPES:
+                self.send_datagrams(datagrams, (MULTICAST_GROUP, MULTICAST_PORT))
+            else:
+                # Send message to all ports
+                self.broadcast_message(datagrams)
             return True
         except Exception as e:
-            print(f"Error sending message: {e}")
+            self.emit('ERROR', content=f"Error sending message: {e}")
             return False
     
-    def receive_messages(self):
-        """Receive and process messages"""
-        self.socket.settimeout(0.5)  # Timeout to allow periodic checks
+    def send_reliable(self, message_type, content, recipient):
+        """Queue a message on the reliable channel of each recipient"""
+        peers = [peer.username for peer in self.clients] if recipient == "ALL" else [recipient]
+        for peer in peers:
+            channel = self.channels.get(peer)
+            if channel is None:
+                # Peer cannot acknowledge: send it a single unicast copy
+                message = self.build_message(message_type, content, recipient)
+                self.send_to(self.encode_datagrams(message, self.peer_version(peer)), self.clients[peer].port)
+                continue
+            channel.backlog.append((message_type, content, recipient))
+            self.fill_window(peer, channel)
+    
+    def fill_window(self, peer, channel):
+        """Send queued messages while the window has room"""
+        while channel.backlog:
+            oldest = next(iter(channel.unacked), channel.next_seq)
+            if channel.next_seq - oldest >= RELIABLE_WINDOW:
+                break
+            message_type, content, recipient = channel.backlog.popleft()
+            seq = channel.next_seq
+            channel.next_seq += 1
+            message = self.build_message(message_type, content, recipient, seq, reliable=True)
+            datagrams = self.encode_datagrams(message, self.peer_version(peer))
+            channel.unacked[seq] = [datagrams, self.loop.time(), 0]
+            self.send_to(datagrams, self.clients[peer].port)
+        self.schedule_retransmit(peer, channel)
+    
+    def schedule_retransmit(self, peer, channel):
+        """Wake up when the oldest unacknowledged message times out"""
+        if channel.retransmit_timer is not None:
+            return
+        if channel.unacked:
+            oldest = min(sent for _, sent, _ in channel.unacked.values())
+            delay = max(oldest + channel.rto - self.loop.time(), 0)
+        elif channel.skip:
+            delay = channel.rto  # Repeat the SKIP until it is acknowledged
+        else:
+            return
+        channel.retransmit_timer = self.loop.call_later(delay, self.retransmit, peer)
+    
+    def retransmit(self, peer):
+        """Resend messages whose acknowledgement is overdue"""
+        channel = self.channels.get(peer)
+        if channel is None or peer not in self.clients:
+            return
+        channel.retransmit_timer = None
+        now = self.loop.time()
+        expired = False
+        
+        for seq, entry in list(channel.unacked.items()):
+            datagrams, sent, retries = entry
+            if sent + channel.rto > now:
+                continue
+            if retries >= MAX_RETRIES:
+                del channel.unacked[seq]
+                channel.skip = max(channel.skip, seq)
+                self.emit('UNDELIVERED', peer)
+                continue
+            entry[1] = now
+            entry[2] = retries + 1
+            self.send_to(datagrams, self.clients[peer].port)
+            expired = True
+        
+        if channel.skip:
+            # Without it, the receiver would wait for the given-up messages forever
+            message = self.build_message('SKIP', '', peer, channel.skip)
+            self.send_to(self.encode_datagrams(message, self.peer_version(peer)), self.clients[peer].port)
+        
+        if expired:
+            channel.rto = min(channel.rto * 2, MAX_RTO)  # Back off
+        self.fill_window(peer, channel)
+    
+    def handle_ack(self, peer, message):
+        """Drop acknowledged messages and update the RTT estimate"""
+        channel = self.channels.get(peer)
+        if channel is None:
+            return
+        cumulative = message['sequence']
+        if cumulative >= channel.skip:
+            channel.skip = 0
+        ranges = parse_sack(message['content'])
+        now = self.loop.time()
+        sample = None
+        
+        for seq in list(channel.unacked):
+            if seq <= cumulative or any(low <= seq <= high for low, high in ranges):
+                _, sent, retries = channel.unacked.pop(seq)
+                if retries == 0:
+                    sample = now - sent  # Karn: only time messages sent once
+        
+        if sample is not None:
+            if channel.srtt is None:
+                channel.srtt = sample
+                channel.rttvar = sample / 2
+            else:
+                channel.rttvar = 0.75 * channel.rttvar + 0.25 * abs(channel.srtt - sample)
+                channel.srtt = 0.875 * channel.srtt + 0.125 * sample
+            channel.rto = min(max(channel.srtt + 4 * channel.rttvar, MIN_RTO), MAX_RTO)
+        
+        # Fast retransmit: a gap below a selectively acknowledged message
+        # was lost if it is older than one round trip
+        if ranges and channel.srtt is not None:
+            highest = max(high for _, high in ranges)
+            for seq, entry in channel.unacked.items():
+                if seq > highest:
+                    break
+                if now - entry[1] > channel.srtt and entry[2] < MAX_RETRIES:
+                    entry[1] = now
+                    entry[2] += 1
+                    self.send_to(entry[0], self.clients[peer].port)
+        
+        if channel.retransmit_timer is not None:
+            channel.retransmit_timer.cancel()
+            channel.retransmit_timer = None
+        self.fill_window(peer, channel)
+    
+    def receive_reliable(self, peer, message):
+        """Return the messages that can now be delivered in order"""
+        channel = self.channels.get(peer)
+        if channel is None:
+            return [message]
+        seq = message['sequence']
+        
+        if seq < channel.expected or seq in channel.received:
+            self.send_ack(peer)  # Duplicate: our ACK was probably lost
+            return []
+        if seq >= channel.expected + RELIABLE_WINDOW:
+            return []  # Outside the window
+        
+        channel.received[seq] = message
+        return self.deliver_in_order(peer, channel)
+    
+    def skip_to(self, peer, seq):
+        """Stop waiting for messages up to seq, which the sender gave up"""
+        channel = self.channels.get(peer)
+        if channel is None:
+            return []
+        # Only the buffered messages are visited, never every skipped number
+        delivered = [channel.received.pop(number)
+                     for number in sorted(channel.received) if number <= seq]
+        channel.expected = max(channel.expected, seq + 1)
+        delivered += self.deliver_in_order(peer, channel)
+        self.send_ack(peer)  # Also stops the sender repeating the SKIP
+        return delivered
+    
+    def deliver_in_order(self, peer, channel):
+        """Return the received messages that follow the last delivered one"""
+        delivered = []
+        while channel.expected in channel.received:
+            delivered.append(channel.received.pop(channel.expected))
+            channel.expected += 1
         
-        while self.running:
+        if channel.received:
+            self.send_ack(peer)  # A gap: report it right away
+        elif channel.ack_timer is None:
+            channel.ack_timer = self.loop.call_later(DELAYED_ACK, self.send_ack, peer)
+        return delivered
+    
+    def send_ack(self, peer):
+        """Acknowledge everything received from a peer so far"""
+        channel = self.channels.get(peer)
+        if channel is None or peer not in self.clients:
+            return
+        if channel.ack_timer is not None:
+            channel.ack_timer.cancel()
+            channel.ack_timer = None
+        
+        blocks = []
+        for seq in sorted(channel.received):
+            if blocks and blocks[-1][1] == seq - 1:
+                blocks[-1][1] = seq
+            elif len(blocks) < MAX_SACK_BLOCKS:
+                blocks.append([seq, seq])
+        content = ','.join(f"{low}-{high}" if high != low else str(low) for low, high in blocks)
+        
+        message = self.build_message('ACK', content, peer, channel.expected - 1)
+        self.send_to(self.encode_datagrams(message, self.peer_version(peer)), self.clients[peer].port)
+    
+    def open_channel(self, peer, session):
+        """Reliable channel for a peer, reset when the peer restarts"""
+        channel = self.channels.get(peer)
+        if channel is not None and channel.session == session:
+            return
+        self.close_channel(peer)
+        self.channels[peer] = PeerChannel(session)
+    
+    def close_channel(self, peer):
+        channel = self.channels.pop(peer, None)
+        if channel is not None:
+            channel.cancel()
+    
+    def piggyback(self):
+        """Membership updates to carry on the next message, ours first"""
+        updates = [[self.username, self.port, ALIVE, self.incarnation, self.wire_version]]
+        for username in heapq.nlargest(MAX_PIGGYBACK, self.updates, key=lambda name: self.updates[name][1]):
+            entry = self.updates[username]
+            updates.append(entry[0])
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.updates[username]
+        return updates
+    
+    def enqueue_update(self, username, port, state, incarnation, version):
+        """Gossip a membership change to about log(N) members per member"""
+        transmissions = RETRANSMIT_MULTIPLIER * math.ceil(math.log2(len(self.members) + 2))
+        self.updates[username] = [[username, port, state, incarnation, version], transmissions]
+    
+    def merge_gossip(self, updates):
+        """Apply membership updates received from another member"""
+        for update in updates:
             try:
-                # Receive data
-                data, addr = self.socket.recvfrom(BUFFER_SIZE)
-                
-                # Decode and process
-                try:
-                    message = json.loads(data.decode('utf-8'))
-                    
-                    # Check if message has all required fields
-                    required_fields = ['type', 'sender', 'sender_port', 'recipient', 'content']
-                    if not all(field in message for field in required_fields):
-                        continue
-                    
-                    # Ignore own messages
-                    sender = message['sender']
-                    sender_port = message['sender_port']
-                    
-                    if sender == self.username and sender_port == self.port:
-                        continue
-                    
-                    # Update active clients list
-                    if sender not in self.clients:
-                        print(f"\nNew user: {sender} (port: {sender_port})")
-                        print("> ", end='', flush=True)
-                    
-                    # Update client information
-                    self.clients[sender] = [sender_port, time.time()]
-                    
-                    # Process message based on type
-                    msg_type = message['type']
-                    
-                    if msg_type == 'HELLO':
-                        # Respond with confirmation message
-                        time.sleep(0.1)  # Small delay to avoid collisions
-                        self.send_message('HELLO_ACK', "I'm here!")
-                    
-                    elif msg_type == 'GENERAL':
-                        if message['recipient'] == 'ALL':
-                            print(f"\n[GENERAL] {sender}: {message['content']}")
-                            print("> ", end='', flush=True)
-                    
-                    elif msg_type == 'PRIVATE':
-                        if message['recipient'] == self.username:
-                            print(f"\n[PRIVATE] {sender}: {message['content']}")
-                            print("> ", end='', flush=True)
-                    
-                    elif msg_type == 'BYE':
-                        if sender in self.clients:
-                            del self.clients[sender]
-                            print(f"\n{sender} has left the conversation")
-                            print("> ", end='', flush=True)
-                
-                except json.JSONDecodeError:
-                    pass  # Ignore messages that are not valid JSON
-                except Exception as e:
-                    print(f"\nError processing message: {e}")
-                    print("> ", end='', flush=True)
-            
-            except socket.timeout:
-                pass  # Normal timeout, continue loop
-            except Exception as e:
+                username, port, state, incarnation, version = update
+            except (TypeError, ValueError):
+                continue
+            
+            if username == self.username:
+                if state != ALIVE and incarnation >= self.incarnation:
+                    # Others think we failed: refute with a newer incarnation
+                    self.incarnation = incarnation + 1
+                    self.enqueue_update(self.username, self.port, ALIVE, self.incarnation, self.wire_version)
+                continue
+            
+            member = self.members.get(username)
+            if member is None:
+                if state == DEAD or incarnation <= self.tombstones.get(username, -1):
+                    continue  # Stale news about a removed member
+                if username not in self.clients:
+                    self.update_client(username, port, version)
+                self.members[username] = [state, incarnation]
+                self.enqueue_update(username, port, state, incarnation, version)
+                if state == SUSPECT:
+                    self.start_suspicion(username)
+                continue
+            
+            known_state, known_incarnation = member
+            if state == ALIVE and incarnation > known_incarnation:
+                member[:] = [ALIVE, incarnation]
+                suspicion = self.suspicions.pop(username, None)
+                if suspicion is not None:
+                    suspicion.cancel()
+            elif state == SUSPECT and (incarnation > known_incarnation or
+                                       (incarnation == known_incarnation and known_state == ALIVE)):
+                member[:] = [SUSPECT, incarnation]
+                self.start_suspicion(username)
+            elif state == DEAD and incarnation >= known_incarnation:
+                self.bury(username, incarnation)
+                self.emit('FAILED', username)
+            else:
+                continue  # Nothing new
+            self.enqueue_update(username, port, state, incarnation, version)
+    
+    def gossip_tick(self):
+        """Start a protocol period: judge the last probe and probe the next member"""
+        self.gossip_timer = self.loop.call_later(GOSSIP_INTERVAL, self.gossip_tick)
+        if self.probe is not None and not self.probe[2]:
+            self.suspect(self.probe[0])
+        self.probe = None
+        
+        # Round-robin over a shuffled list, so every member is probed once per round
+        while self.probe_order or self.members:
+            if not self.probe_order:
+                self.probe_order = list(self.members)
+                random.shuffle(self.probe_order)
+            target = self.probe_order.pop()
+            if target in self.members:
+                break
+        else:
+            return
+        
+        self.probe_seq = (self.probe_seq + 1) & 0xFFFFFFFF
+        self.probe = [target, self.probe_seq, False]
+        self.send_control('PING', '', target, self.probe_seq)
+        self.loop.call_later(PING_TIMEOUT, self.indirect_probe, self.probe_seq)
+    
+    def indirect_probe(self, seq):
+        """Ask a few other members to probe a member that did not answer"""
+        if self.probe is None or self.probe[1] != seq or self.probe[2]:
+            return
+        target = self.probe[0]
+        helpers = [username for username in self.members if username != target]
+        for helper in random.sample(helpers, min(INDIRECT_PROBES, len(helpers))):
+            self.send_control('PING_REQ', target, helper, seq)
+    
+    def send_control(self, message_type, content, username, seq):
+        """Send a gossip protocol message to one member"""
+        peer = self.clients.get(username)
+        if peer is not None:
+            message = self.build_message(message_type, content, username, seq)
+            self.send_to(self.encode_datagrams(message, self.peer_version(username)), peer.port)
+    
+    def handle_probe(self, sender, message):
+        """Answer PING, PING_REQ and PING_ACK messages"""
+        msg_type = message['type']
+        seq = message['sequence']
+        
+        if msg_type == 'PING':
+            self.send_control('PING_ACK', self.username, sender, seq)
+        
+        elif msg_type == 'PING_REQ':
+            # Probe the target on the requester's behalf and relay the answer
+            self.probe_seq = (self.probe_seq + 1) & 0xFFFFFFFF
+            self.relays[self.probe_seq] = (sender, seq)
+            self.loop.call_later(GOSSIP_INTERVAL, self.relays.pop, self.probe_seq, None)
+            self.send_control('PING', '', message['content'], self.probe_seq)
+        
+        elif msg_type == 'PING_ACK':
+            if self.probe is not None and self.probe[1] == seq and self.probe[0] == message['content']:
+                self.probe[2] = True
+            elif seq in self.relays:
+                requester, requester_seq = self.relays.pop(seq)
+                self.send_control('PING_ACK', message['content'], requester, requester_seq)
+    
+    def suspect(self, username):
+        """Mark a member that failed a probe as suspected, and tell the others"""
+        member = self.members.get(username)
+        if member is None or member[0] != ALIVE:
+            return
+        member[0] = SUSPECT
+        self.start_suspicion(username)
+        peer = self.clients[username]
+        self.enqueue_update(username, peer.port, SUSPECT, member[1], peer.version)
+    
+    def start_suspicion(self, username):
+        if username in self.suspicions:
+            return
+        timeout = SUSPICION_MULTIPLIER * max(1, math.log10(len(self.members) + 1)) * GOSSIP_INTERVAL
+        self.suspicions[username] = self.loop.call_later(timeout, self.confirm_dead, username)
+    
+    def confirm_dead(self, username):
+        """A suspected member did not refute in time: remove it"""
+        self.suspicions.pop(username, None)
+        member = self.members.get(username)
+        if member is None or member[0] != SUSPECT:
+            return
+        peer = self.clients[username]
+        self.enqueue_update(username, peer.port, DEAD, member[1], peer.version)
+        self.bury(username, member[1])
+        self.emit('FAILED', username)
+    
+    def bury(self, username, incarnation):
+        """Remove a failed or departed member, ignoring older gossip about it for a while"""
+        self.remove_client(username)
+        self.tombstones[username] = incarnation
+        self.loop.call_later(DEAD_RETENTION, self.tombstones.pop, username, None)
+    
+    def emit(self, event_type, username='', content='', port=None, message=None):
+        """Report an event to the application: a received message, a join, a failure..."""
+        if message is None:
+            message = {'type': event_type, 'sender': username, 'content': content,
+                       'sender_port': port, 'timestamp': time.time()}
+        if self.on_event is not None:
+            self.on_event(message)
+        else:
+            self.events.put_nowait(message)
+    
+    def read_ready(self, sock):
+        """Handle every datagram waiting on the socket, up to READ_BATCH"""
+        for _ in range(READ_BATCH):
+            try:
+                data, addr = sock.recvfrom(BUFFER_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
                 if self.running:
-                    print(f"\nError receiving messages: {e}")
-                    print("> ", end='', flush=True)
+                    self.emit('ERROR', content=f"Error receiving messages: {e}")
+                return
+            self.datagrams_received += 1
+            self.handle_datagram(data, addr)
     
-    def heartbeat_thread(self):
-        """Periodically send messages to maintain presence"""
-        last_heartbeat = 0
-        last_cleanup = 0
+    def reassemble(self, data, addr):
+        """Store a fragment, return the whole message once it is complete"""
+        _, flags, index, count, message_id = FRAGMENT_HEADER.unpack_from(data)
+        if not 0 < count <= MAX_FRAGMENTS or index >= count:
+            return None
         
-        while self.running:
-            current_time = time.time()
-            
-            # Send a heartbeat every 5 seconds
-            if current_time - last_heartbeat > 5:
-                self.send_message('HEARTBEAT', "I'm active")
-                last_heartbeat = current_time
-            
-            # Clean inactive clients every 15 seconds
-            if current_time - last_cleanup > 15:
-                inactive_threshold = current_time - 30  # 30 seconds without activity = inactive
-                inactive_clients = [username for username, [_, last_seen] in self.clients.items() 
-                                  if last_seen < inactive_threshold]
-                
-                for username in inactive_clients:
-                    del self.clients[username]
-                
-                last_cleanup = current_time
+        key = (addr, message_id)
+        partial = self.partial.get(key)
+        if partial is None:
+            if len(self.partial) >= MAX_PARTIAL:
+                return None
+            timer = self.loop.call_later(REASSEMBLY_TIMEOUT, self.partial.pop, key, None)
+            partial = self.partial[key] = PartialMessage(flags, count, timer)
+        if len(partial.chunks) != count or partial.chunks[index] is not None:
+            return None  # Duplicate or inconsistent fragment
+        
+        partial.chunks[index] = data[FRAGMENT_HEADER.size:]
+        partial.missing -= 1
+        if partial.missing:
+            return None
+        
+        del self.partial[key]
+        partial.timer.cancel()
+        data = b''.join(partial.chunks)
+        if partial.flags & FRAGMENT_COMPRESSED:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(data, MAX_FRAGMENTS * FRAGMENT_SIZE * 8)
+            if decompressor.unconsumed_tail:
+                return None  # Refuse to inflate beyond a sane size
+        return data
+    
+    def handle_datagram(self, data, addr=None):
+        """Process one received datagram"""
+        try:
+            if data[:1] == bytes((FRAGMENT_MAGIC,)):
+                data = self.reassemble(data, addr)
+                if data is None:
+                    return
+            
+            message = decode_message(data)
+            if message is None:
+                return
+            
+            # Ignore own messages
+            sender = message['sender']
+            sender_port = message['sender_port']
+            
+            if sender == self.username and sender_port == self.port:
+                return
             
-            time.sleep(1)
+            # Update active clients list
+            # Peers without a version field only speak JSON
+            self.update_client(sender, sender_port, message.get('version', 0))
+            self.schedule_expiry()
+            if min(self.wire_version, message.get('version', 0)) >= 3:
+                self.open_channel(sender, message['sender_id'])
+            if self.gossip and message.get('gossip'):
+                self.tombstones.pop(sender, None)  # Heard from it directly
+                self.merge_gossip(message['gossip'])
+            
+            # Process message based on type
+            msg_type = message['type']
+            
+            if msg_type == 'ACK':
+                self.handle_ack(sender, message)
+            
+            elif msg_type in ('PING', 'PING_REQ', 'PING_ACK'):
+                self.handle_probe(sender, message)
+            
+            elif msg_type == 'HELLO':
+                self.queue_hello_ack(sender, sender_port)
+            
+            elif msg_type == 'HELLO_ACK':
+                if message.get('gossip'):
+                    if not self.gossip:
+                        self.learn_peers(message['gossip'])
+                    if message['recipient'] == 'ALL':
+                        self.suppress_hello_acks(message['gossip'])
+            
+            elif msg_type in RELIABLE_TYPES or msg_type == 'SKIP':
+                # Reliable messages are delivered once and in order
+                if msg_type == 'SKIP':
+                    messages = self.skip_to(sender, message['sequence'])
+                elif message.get('reliable'):
+                    messages = self.receive_reliable(sender, message)
+                else:
+                    messages = [message]
+                for message in messages:
+                    if message['type'] == 'GENERAL' and message['recipient'] == 'ALL':
+                        self.emit('GENERAL', message=message)
+                    elif message['type'] == 'PRIVATE' and message['recipient'] == self.username:
+                        self.emit('PRIVATE', message=message)
+            
+            elif msg_type == 'BYE':
+                if sender in self.clients:
+                    # A tombstone keeps gossip still in flight from bringing it back
+                    member = self.members.get(sender)
+                    incarnation = member[1] if member else 0
+                    if self.gossip:
+                        peer = self.clients[sender]
+                        self.enqueue_update(sender, peer.port, DEAD, incarnation, peer.version)
+                    self.bury(sender, incarnation)
+                    self.emit('LEAVE', sender)
+        
+        except Exception as e:
+            self.emit('ERROR', content=f"Error processing message: {e}")
     
-    def start(self):
-        """Start the chat application"""
-        print(f"Starting UDP Chat application as '{self.username}'...")
+    def queue_hello_ack(self, username, port):
+        """Answer a HELLO once per window, after a random delay that batches joins"""
+        now = time.time()
+        while self.hellos_answered and next(iter(self.hellos_answered.values())) < now - HELLO_WINDOW:
+            self.hellos_answered.popitem(last=False)
+        key = (username, port)
+        if key in self.hellos_pending or key in self.hellos_answered:
+            return
+        self.hellos_pending[key] = None
+        if self.hello_timer is None:
+            self.hello_timer = self.loop.call_later(random.uniform(ACK_DELAY / 2, ACK_DELAY),
+                                                    self.answer_hellos)
+    
+    def answer_hellos(self):
+        """Answer the queued HELLOs, with one reply to everybody if several users joined"""
+        self.hello_timer = None
+        joiners = list(self.hellos_pending)
+        self.hellos_pending.clear()
+        now = time.time()
+        for key in joiners:
+            self.hellos_answered[key] = now
         
-        # Start thread for receiving messages
-        receive_thread = threading.Thread(target=self.receive_messages)
-        receive_thread.daemon = True
-        receive_thread.start()
+        # Everybody is reached with one datagram in multicast mode, and with one
+        # per port of the range otherwise
+        if len(joiners) > 1 and (self.multicast or len(joiners) >= self.port_range):
+            message = self.build_message('HELLO_ACK', "I'm here!", "ALL")
+            message['gossip'] = message.get('gossip', []) + self.join_members(())
+            datagrams = self.encode_datagrams(message, self.peer_version("ALL"))
+            if self.multicast:
+                self.send_datagrams(datagrams, (MULTICAST_GROUP, MULTICAST_PORT))
+            else:
+                self.broadcast_message(datagrams)
+        else:
+            for username, port in joiners:
+                self.send_hello_ack(username, port)
+    
+    def suppress_hello_acks(self, members):
+        """Skip our answer to the queued HELLOs if a reply to everybody already listed us"""
+        if self.hello_timer is None or not any(member[0] == self.username for member in members):
+            return
+        # Peers older than version 4 cannot read the list
+        for username, _ in self.hellos_pending:
+            peer = self.clients.get(username)
+            if peer is None or peer.version < 4:
+                return
+        self.hello_timer.cancel()
+        self.hello_timer = None
+        now = time.time()
+        for key in self.hellos_pending:
+            self.hellos_answered[key] = now
+        self.hellos_pending.clear()
+    
+    def join_members(self, exclude):
+        """Some known users as gossip entries, to introduce them to new users"""
+        if self.gossip:
+            names = [name for name in self.members if name not in exclude]
+            entries = []
+            for name in random.sample(names, min(MAX_JOIN_MEMBERS, len(names))):
+                peer = self.clients[name]
+                state, incarnation = self.members[name]
+                entries.append([name, peer.port, state, incarnation, peer.version])
+            return entries
+        # Without gossip, only users heard from recently are passed on
+        recent = time.time() - 2 * HEARTBEAT_INTERVAL
+        peers = [peer for peer in self.clients if peer.last_seen > recent and peer.username not in exclude]
+        return [[peer.username, peer.port, ALIVE, 0, peer.version]
+                for peer in random.sample(peers, min(MAX_JOIN_MEMBERS, len(peers)))]
+    
+    def learn_peers(self, members):
+        """Add users listed in a HELLO_ACK that we have not heard from yet"""
+        for username, port, state, incarnation, version in members:
+            if (state == ALIVE and username != self.username and port != self.port
+                    and username not in self.clients and self.clients.by_port(port) is None
+                    and incarnation > self.tombstones.get(username, -1)):
+                self.update_client(username, port, version)
+        self.schedule_expiry()
+    
+    def send_hello_ack(self, username, port):
+        """Answer a HELLO, listing some members to a new gossip member"""
+        message = self.build_message('HELLO_ACK', "I'm here!", username)
+        if self.gossip:
+            message['gossip'] += self.join_members((username,))
+        self.send_to(self.encode_datagrams(message, self.peer_version(username)), port)
+    
+    def heartbeat(self):
+        """Send a heartbeat and schedule the next one"""
+        self.send_message('HEARTBEAT', "I'm active")
+        self.heartbeat_timer = self.loop.call_later(HEARTBEAT_INTERVAL, self.heartbeat)
+    
+    def schedule_expiry(self):
+        """Wake up when the least recently seen user times out"""
+        if self.expiry_timer is not None or not self.clients or self.gossip:
+            return  # Already scheduled, nobody to expire, or failures are gossiped
+        delay = max(self.clients.oldest().last_seen + INACTIVE_TIMEOUT - time.time(), 0)
+        self.expiry_timer = self.loop.call_later(delay, self.expire_clients)
+    
+    def expire_clients(self):
+        """Remove users without activity for INACTIVE_TIMEOUT seconds"""
+        self.expiry_timer = None
+        inactive_threshold = time.time() - INACTIVE_TIMEOUT
         
-        # Start thread for heartbeat
-        heartbeat_thread = threading.Thread(target=self.heartbeat_thread)
-        heartbeat_thread.daemon = True
-        heartbeat_thread.start()
+        # Everyone has the same timeout, so the users to expire are at the front
+        while True:
+            peer = self.clients.oldest()
+            if peer is None or peer.last_seen > inactive_threshold:
+                break
+            self.remove_client(peer.username)
         
-        # Announce initial presence multiple times
-        for _ in range(5):
-            self.send_message('HELLO', "Has joined the conversation")
-            time.sleep(0.2)
+        self.schedule_expiry()
+    
+    # Headless API
+    
+    async def open(self, announce=True):
+        """Start receiving and the timers, then announce ourselves with HELLO"""
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue()
+        self.sockets = [self.socket] + ([self.group_socket] if self.multicast else [])
+        for sock in self.sockets:
+            sock.setblocking(False)
+            self.loop.add_reader(sock.fileno(), self.read_ready, sock)
+        if self.gossip:
+            self.gossip_tick()
+        else:
+            self.heartbeat()
         
-        # Wait for discovery of other users
-        print("Searching for other users...")
-        time.sleep(2)
+        if announce:
+            # Announce initial presence multiple times
+            for _ in range(5):
+                self.send_message('HELLO', "Has joined the conversation")
+                await asyncio.sleep(0.2)
+    
+    async def close(self, linger=0.5):
+        """Say goodbye and release the sockets"""
+        self.running = False
+        for timer in (self.heartbeat_timer, self.expiry_timer, self.gossip_timer, self.hello_timer):
+            if timer is not None:
+                timer.cancel()
+        for timer in self.suspicions.values():
+            timer.cancel()
+        self.send_message('BYE', "Has left the conversation")
+        await asyncio.sleep(linger)
+        for timer in [partial.timer for partial in self.partial.values()]:
+            timer.cancel()
+        for channel in self.channels.values():
+            channel.cancel()
+        for sock in self.sockets:
+            self.loop.remove_reader(sock.fileno())
+            sock.close()
+    
+    def send(self, content, recipient=None):
+        """Send a general message, or a private one to a connected user"""
+        if recipient is None:
+            return self.send_message('GENERAL', content)
+        if recipient not in self.clients:
+            return False
+        return self.send_message('PRIVATE', content, recipient, self.clients[recipient].port)
+    
+    def users(self):
+        """Connected users as (username, port) pairs"""
+        return [(peer.username, peer.port) for peer in self.clients]
+    
+    async def messages(self):
+        """Received messages and other events, as an async iterator"""
+        while True:
+            yield await self.events.get()
+    
+    def __aiter__(self):
+        return self.messages()
+    
+    # Terminal UI
+    
+    @staticmethod
+    def format_event(event):
+        sender = event['sender']
+        return {
+            'GENERAL': f"[GENERAL] {sender}: {event['content']}",
+            'PRIVATE': f"[PRIVATE] {sender}: {event['content']}",
+            'JOIN': f"New user: {sender} (port: {event['sender_port']})",
+            'LEAVE': f"{sender} has left the conversation",
+            'FAILED': f"{sender} is not responding and was removed",
+            'UNDELIVERED': f"A message to {sender} could not be delivered",
+        }.get(event['type'], event['content'])
+    
+    async def show_events(self):
+        """Print the events produced by the engine"""
+        async for event in self:
+            print(f"\n{self.format_event(event)}")
+            print("> ", end='', flush=True)
+    
+    def read_input(self, done):
+        """Read commands from the terminal and run them on the event loop"""
+        try:
+            while self.running:
+                user_input = input("> ")
+                
+                if not user_input.strip():
+                    continue
+                
+                command = asyncio.run_coroutine_threadsafe(self.handle_input(user_input), self.loop)
+                if not command.result():
+                    break
+        except EOFError:
+            pass
+        except Exception as e:
+            print(f"Error in main loop: {e}")
+        finally:
+            self.loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+    
+    def print_clients(self):
+        for peer in self.clients:
+            state = self.members.get(peer.username, [ALIVE])[0]
+            print(f"- {peer.username} (port: {peer.port})" + (" [suspected]" if state == SUSPECT else ""))
+    
+    async def handle_input(self, user_input):
+        """Run one command, False once the user quits"""
+        if user_input.strip().lower() == '/quit':
+            return False
+        elif user_input.startswith('/p '):
+            # Private message
+            parts = user_input[3:].strip().split(' ', 1)
+            if len(parts) != 2:
+                print("Usage: /p <username> <message>")
+                return True
+            
+            recipient, message = parts
+            
+            if not self.send(message, recipient):
+                print(f"User {recipient} is not connected")
+                return True
+                
+            print(f"Private message sent to {recipient}")
+            
+        elif user_input.strip().lower() == '/list':
+            if not self.clients:
+                print("\nNo other users connected")
+            else:
+                print("\nConnected users:")
+                self.print_clients()
+            print()
+            
+        elif user_input.strip().lower() == '/refresh':
+            print("\nUpdating user list...")
+            for _ in range(3):
+                self.send_message('HELLO', "Update")
+                await asyncio.sleep(0.2)
+            
+            await asyncio.sleep(1)  # Wait for responses
+            
+            if not self.clients:
+                print("No other users connected")
+            else:
+                print("Connected users:")
+                self.print_clients()
+            print()
+            
+        else:
+            # General message
+            self.send(user_input)
+        return True
+    
+    async def run(self):
+        """Run the engine and the terminal UI until the user quits"""
+        await self.open(announce=False)
+        ui = asyncio.create_task(self.show_events())
         
-        # Main loop
         try:
+            # Announce initial presence multiple times
+            for _ in range(5):
+                self.send_message('HELLO', "Has joined the conversation")
+                await asyncio.sleep(0.2)
+            
+            # Wait for discovery of other users
+            print("Searching for other users...")
+            await asyncio.sleep(2)
+            
             print("\nWelcome to UDP Chat!")
             print("Commands:")
             print("  /p <username> <message> - Send a private message")
@@ -207,76 +1314,62 @@ class UDPChat:
             print("  /quit - Exit the conversation")
             print()
             
-            while True:
-                user_input = input("> ")
-                
-                if not user_input.strip():
-                    continue
-                
-                if user_input.strip().lower() == '/quit':
-                    break
-                elif user_input.startswith('/p '):
-                    # Private message
-                    parts = user_input[3:].strip().split(' ', 1)
-                    if len(parts) != 2:
-                        print("Usage: /p <username> <message>")
-                        continue
-                    
-                    recipient, message = parts
-                    
-                    if recipient not in self.clients:
-                        print(f"User {recipient} is not connected")
-                        continue
-                        
-                    self.send_message('PRIVATE', message, recipient)
-                    print(f"Private message sent to {recipient}")
-                    
-                elif user_input.strip().lower() == '/list':
-                    if not self.clients:
-                        print("\nNo other users connected")
-                    else:
-                        print("\nConnected users:")
-                        for username, [port, _] in self.clients.items():
-                            print(f"- {username} (port: {port})")
-                    print()
-                    
-                elif user_input.strip().lower() == '/refresh':
-                    print("\nUpdating user list...")
-                    for _ in range(3):
-                        self.send_message('HELLO', "Update")
-                        time.sleep(0.2)
-                    
-                    time.sleep(1)  # Wait for responses
-                    
-                    if not self.clients:
-                        print("No other users connected")
-                    else:
-                        print("Connected users:")
-                        for username, [port, _] in self.clients.items():
-                            print(f"- {username} (port: {port})")
-                    print()
-                    
-                else:
-                    # General message
-                    self.send_message('GENERAL', user_input)
+            # input() blocks, so the terminal is read on its own thread
+            done = self.loop.create_future()
+            input_thread = threading.Thread(target=self.read_input, args=(done,))
+            input_thread.daemon = True
+            input_thread.start()
+            await done
         
-        except KeyboardInterrupt:
+        except asyncio.CancelledError:
             print("\nClosing application...")
-        except Exception as e:
-            print(f"Error in main loop: {e}")
         finally:
-            self.running = False
-            self.send_message('BYE', "Has left the conversation")
-            time.sleep(0.5)
-            self.socket.close()
-            print("UDP Chat application has been closed.")
+            await self.close()
+            ui.cancel()
+    
+    def start(self):
+        """Start the chat application"""
+        print(f"Chat successfully initialized on port {self.port}")
+        if self.multicast:
+            print(f"Joined multicast group {MULTICAST_GROUP}:{MULTICAST_PORT}")
+        print(f"Starting UDP Chat application as '{self.username}'...")
+        if sys.platform == 'win32':
+            # The engine watches its sockets with add_reader()
+            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            pass
+        print("UDP Chat application has been closed.")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python udp_chat.py <username>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Peer-to-peer UDP chat")
+    parser.add_argument("username")
+    parser.add_argument("--multicast", action="store_true",
+                        help=f"send messages for all peers to {MULTICAST_GROUP}:{MULTICAST_PORT}")
+    parser.add_argument("--json", action="store_true",
+                        help="only use the original JSON message format")
+    parser.add_argument("--compress", action="store_true",
+                        help=f"zlib-compress messages larger than {COMPRESS_THRESHOLD} bytes")
+    parser.add_argument("--rcvbuf", type=int, default=DEFAULT_RCVBUF,
+                        help=f"socket receive buffer size in bytes (default {DEFAULT_RCVBUF})")
+    parser.add_argument("--sndbuf", type=int, help="socket send buffer size in bytes")
+    parser.add_argument("--reliable", action="store_true",
+                        help="acknowledge and retransmit general and private messages")
+    parser.add_argument("--base-port", type=int, default=BASE_PORT,
+                        help=f"first port of the range (default {BASE_PORT})")
+    parser.add_argument("--port-range", type=int, default=PORT_RANGE,
+                        help=f"number of ports in the range (default {PORT_RANGE})")
+    parser.add_argument("--gossip", action="store_true",
+                        help="detect failed users by gossip instead of heartbeats to everyone")
+    args = parser.parse_args()
     
     # Initialize and start chat
-    username = sys.argv[1]
-    chat = UDPChat(username)
+    try:
+        chat = UDPChat(args.username, args.multicast, 0 if args.json else WIRE_VERSION,
+                       args.compress, args.rcvbuf, args.sndbuf, args.reliable,
+                       args.base_port, args.port_range, args.gossip)
+    except OSError as e:
+        print(e)
+        sys.exit(1)
     chat.start()
\ No newline at end of file
@@ -1,16 +1,398 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import os
+import queue
 import socket
+import sqlite3
 import sys
 import re
+import threading
+import time
+from collections import OrderedDict
+import dns.asyncresolver
+import dns.exception
+import dns.flags
+import dns.message
+import dns.opcode
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
 import dns.resolver
 import dns.reversename
 
-class DNSClient:
+# Answer cache
+CACHE_SIZE = 1024     # Answers kept in memory, least recently used are evicted
+NEGATIVE_TTL = 300    # Seconds to remember a missing name when the reply has no SOA
+REFRESH_AHEAD = 0.1   # Refresh hot answers during the last 10% of their TTL
+HOT_HITS = 2          # Cache hits that make an answer worth refreshing
+COMPACT_INTERVAL = 3600  # Seconds between removals of expired answers from the cache file
+COMPACT_BATCH = 500      # Expired answers removed per transaction
+
+# Nameserver selection
+STATS_ALPHA = 0.2      # Weight of the newest query in the moving averages
+FAILURE_PENALTY = 2.0  # Seconds a failed query is assumed to cost, the resolver's timeout
+STATS_STALE = 60       # Seconds after which an unused server is tried again
+
+# Bulk mode
+BULK_LIMIT = 100      # Queries in flight at once
+BULK_TIMEOUT = 5.0    # Seconds before a query is given up
+READ_HINT = 1 << 16   # Bytes of input read at a time
+
+# Server mode
+SERVER_PORT = 5353    # Default port of the local DNS server, 53 needs root
+UDP_SIZE = 512        # Largest UDP reply to clients without EDNS
+TCP_IDLE = 10         # Seconds before an idle TCP connection is closed
+TCP_PIPELINE = 64     # Queries of one TCP connection answered at the same time
+
+
+def negative_ttl(responses):
+    """Returns how long a negative answer may be cached (RFC 2308)."""
+    for response in responses:
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return min(rrset.ttl, rrset[0].minimum)
+    return NEGATIVE_TTL
+
+
+def answer_entry(answers):
+    """Returns (records, None, TTL) for a resolver answer."""
+    # The expiration covers every record of a CNAME chain
+    return [str(rdata) for rdata in answers], None, max(0, answers.expiration - time.time())
+
+
+def negative_entry(error):
+    """Returns ([], error class, TTL) for an NXDOMAIN or NoAnswer exception."""
+    if isinstance(error, dns.resolver.NXDOMAIN):
+        return [], dns.resolver.NXDOMAIN, negative_ttl(error.responses().values())
+    return [], dns.resolver.NoAnswer, negative_ttl([error.response()])
+
+
+def resolve_entry(resolver, name, rdtype, lifetime):
+    """Sends a query, returns (records, error class, TTL) for answers and missing names."""
+    try:
+        return answer_entry(resolver.resolve(name, rdtype, lifetime=lifetime))
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+        return negative_entry(e)
+
+
+async def resolve_entry_async(resolver, name, rdtype, lifetime):
+    """Like resolve_entry(), with an asyncio resolver."""
+    try:
+        return answer_entry(await resolver.resolve(name, rdtype, lifetime=lifetime))
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+        return negative_entry(e)
+
+
+# Errors that count against a server: no reply, or a reply that is not an answer
+SERVER_ERRORS = (dns.exception.Timeout, dns.resolver.NoNameservers, OSError)
+
+
+# Negative answers, by the name stored in the cache file
+ERRORS = {error.__name__: error for error in (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)}
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    name TEXT NOT NULL,
+    rdtype TEXT NOT NULL,
+    nameservers TEXT NOT NULL,
+    records TEXT NOT NULL,
+    error TEXT,
+    ttl REAL NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (name, rdtype, nameservers)
+);
+CREATE INDEX IF NOT EXISTS answers_expires ON answers (expires);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL);
+INSERT OR IGNORE INTO meta VALUES ('compacted', 0);
+"""
+
+
+class CacheEntry:
+    """A cached answer: the records, or the error class for a negative answer."""
+    
+    __slots__ = ('records', 'error', 'ttl', 'expires', 'hits', 'refreshing')
+    
+    def __init__(self, records, error, ttl, expires=None):
+        self.records = records
+        self.error = error
+        self.ttl = ttl
+        self.expires = time.time() + ttl if expires is None else expires
+        self.hits = 0
+        self.refreshing = False
+
+
+class DiskCache:
+    """Answers kept in an SQLite file with absolute expiry times, shared by processes."""
+    
+    def __init__(self, path):
+        self.path = path
+        self.db = None  # Opened on first use, so startup stays fast
+        self.lock = threading.Lock()
+        self.writes = None  # Answers waiting for the writer thread, once it has started
+    
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        # With a write-ahead log, readers in other processes do not block writers
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+    
+    def open(self):
+        if self.db is None:
+            self.db = self.connect()
+            self.db.executescript(CACHE_SCHEMA)
+            threading.Thread(target=self.compact, daemon=True).start()
+        return self.db
+    
+    def get(self, key):
+        """Returns (records, error class, TTL, expiry time) for a live answer, or None."""
+        name, rdtype, nameservers = key
+        try:
+            with self.lock:
+                row = self.open().execute(
+                    "SELECT records, error, ttl, expires FROM answers "
+                    "WHERE name = ? AND rdtype = ? AND nameservers = ? AND expires > ?",
+                    (name, rdtype, ",".join(nameservers), time.time())).fetchone()
+        except sqlite3.Error:
+            return None  # The network still works without the cache file
+        if row is None:
+            return None
+        records, error, ttl, expires = row
+        return json.loads(records), ERRORS.get(error), ttl, expires
+    
+    def put(self, key, records, error, ttl):
+        try:
+            with self.lock:
+                self.write(self.open(), key, records, error, ttl, time.time() + ttl)
+        except sqlite3.Error:
+            pass
+    
+    @staticmethod
+    def write(db, key, records, error, ttl, expires):
+        name, rdtype, nameservers = key
+        db.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                   (name, rdtype, ",".join(nameservers), json.dumps(records),
+                    error and error.__name__, ttl, expires))
+    
+    def put_later(self, key, records, error, ttl):
+        """Queues an answer for a background thread to write, so the caller never waits on the file."""
+        if self.writes is None:
+            self.writes = queue.SimpleQueue()
+            threading.Thread(target=self.write_loop, daemon=True).start()
+        self.writes.put((key, records, error, ttl, time.time() + ttl))
+    
+    def write_loop(self):
+        """Writes queued answers on a connection of its own, so reads never wait behind a locked file."""
+        db = None
+        while True:
+            answer = self.writes.get()
+            try:
+                if db is None:
+                    with self.lock:
+                        self.open()  # Creates the tables
+                    db = self.connect()
+                self.write(db, *answer)
+            except sqlite3.Error:
+                pass  # The answer is still cached in memory
+    
+    def flush(self):
+        """Writes the answers still waiting for the writer thread, in one transaction."""
+        answers = []
+        while self.writes is not None:
+            try:
+                answers.append(self.writes.get_nowait())
+            except queue.Empty:
+                break
+        if not answers:
+            return
+        try:
+            with self.lock:
+                db = self.open()
+                db.execute("BEGIN")
+                try:
+                    for answer in answers:
+                        self.write(db, *answer)
+                    db.execute("COMMIT")
+                except sqlite3.Error:
+                    db.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error:
+            pass
+    
+    def clear(self):
+        try:
+            with self.lock:
+                self.open().execute("DELETE FROM answers")
+        except sqlite3.Error:
+            pass
+    
+    def compact(self):
+        """Removes expired answers in the background, once per interval across all processes."""
+        db = self.connect()
+        while True:
+            try:
+                # Claiming the interval in the file stops short-lived runs from all compacting
+                now = time.time()
+                claimed = db.execute("UPDATE meta SET value = ? WHERE key = 'compacted' AND value < ?",
+                                     (now, now - COMPACT_INTERVAL)).rowcount
+                # Small transactions keep the write lock short for other processes
+                while claimed and db.execute(
+                        "DELETE FROM answers WHERE rowid IN "
+                        "(SELECT rowid FROM answers WHERE expires <= ? LIMIT ?)",
+                        (now, COMPACT_BATCH)).rowcount == COMPACT_BATCH:
+                    pass
+            except sqlite3.Error:
+                pass  # Try again in the next interval
+            time.sleep(COMPACT_INTERVAL)
+
+
+class ServerStats:
+    """Moving averages of the latency and failures of one DNS server."""
+    
+    __slots__ = ('latency', 'failure_rate', 'queries', 'last_used', 'probing')
+    
     def __init__(self):
-        self.custom_dns = None
+        self.latency = 0.0
+        self.failure_rate = 0.0
+        self.queries = 0
+        self.last_used = 0.0
+        self.probing = False  # A query is finding out whether the server works
+    
+    def untested(self, now):
+        return not self.queries or now - self.last_used > STATS_STALE
+    
+    def record(self, latency, failed):
+        if failed:
+            self.failure_rate += STATS_ALPHA * (1 - self.failure_rate)
+        else:
+            self.failure_rate -= STATS_ALPHA * self.failure_rate
+            self.latency = latency if not self.latency else self.latency + STATS_ALPHA * (latency - self.latency)
+        self.queries += 1
+        self.last_used = time.time()
+    
+    def score(self, now):
+        """Returns the expected seconds per query, 0 for servers worth trying again."""
+        if self.probing:
+            return FAILURE_PENALTY  # Other queries wait for the outcome
+        if self.untested(now):
+            return 0
+        return self.latency + self.failure_rate * FAILURE_PENALTY
+
+
+class UDPServer(asyncio.DatagramProtocol):
+    """Answers DNS queries over UDP with a DNSClient."""
+    
+    def __init__(self, client):
+        self.client = client
+        self.transport = None
+    
+    def connection_made(self, transport):
+        self.transport = transport
+    
+    def datagram_received(self, data, addr):
+        reply = self.client.answer_query(data)
+        if asyncio.iscoroutine(reply):
+            asyncio.ensure_future(self.send_later(reply, addr))
+        elif reply is not None:
+            # Cache hits are answered right away
+            self.transport.sendto(reply, addr)
+    
+    async def send_later(self, reply, addr):
+        self.transport.sendto(await reply, addr)
+
+
+class AnswerCache:
+    """Answers keyed by (name, type, nameservers), expiring with their TTL."""
+    
+    def __init__(self, size=CACHE_SIZE, store=None):
+        self.size = size
+        self.entries = OrderedDict()  # key -> CacheEntry, least recently used first
+        self.lock = threading.Lock()
+        self.store = store  # DiskCache behind the memory, or None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+    
+    def get(self, key, load=True):
+        """Returns the live entry for a key, or None.
+        
+        With load=False only the memory is searched, and the caller looks in the
+        cache file with load(), for example on another thread.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires <= time.time():
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                entry.hits += 1
+                self.hits += 1
+                return entry
+            if self.store is None:
+                self.misses += 1
+                return None
+        return self.load(key) if load else None
+    
+    def load(self, key):
+        """Returns the live answer for a key from the cache file, or None."""
+        stored = self.store.get(key) if self.store is not None else None
+        with self.lock:
+            if stored is None:
+                self.misses += 1
+                return None
+            entry = CacheEntry(*stored)
+            self.insert(key, entry)
+            entry.hits += 1
+            self.hits += 1
+            self.disk_hits += 1
+            return entry
+    
+    def put(self, key, records, error, ttl, wait=True):
+        """Stores an answer, evicting the least recently used ones if full.
+        
+        With wait=False the cache file is written by a background thread.
+        """
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.insert(key, CacheEntry(records, error, ttl))
+        if self.store is not None:
+            if wait:
+                self.store.put(key, records, error, ttl)
+            else:
+                self.store.put_later(key, records, error, ttl)
+    
+    def insert(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+        if self.store is not None:
+            self.store.clear()
+
+
+class DNSClient:
+    def __init__(self, cache_size=CACHE_SIZE, refresh_ahead=False, cache_file=None, race=False):
+        self.custom_dns = None  # DNS servers set with 'use dns', or None for the system ones
         self.resolver = dns.resolver.Resolver()
         # Keep the default DNS servers
         self.system_dns = self.resolver.nameservers.copy()
+        self.cache = AnswerCache(cache_size, DiskCache(cache_file) if cache_file else None)
+        self.refresh_ahead = refresh_ahead
+        self.race = race
+        self.stats = {}  # server -> ServerStats
+        self.inflight = {}  # cache key -> task resolving it upstream, in server mode
     
     def is_valid_ip(self, ip):
         """Checks if a string is a valid IP address."""
@@ -26,17 +408,158 @@ class DNSClient:
         
         return True
     
+    def nameservers(self):
+        """Returns the DNS servers currently in use."""
+        return self.custom_dns or self.system_dns
+    
+    def server_stats(self, server):
+        stats = self.stats.get(server)
+        if stats is None:
+            stats = self.stats[server] = ServerStats()
+        return stats
+    
+    def ranked(self, servers):
+        """Returns the servers, the fastest and most reliable first."""
+        now = time.time()
+        return sorted(servers, key=lambda server: self.server_stats(server).score(now))
+    
+    def next_server(self, servers):
+        """Removes and returns the best of the servers not tried yet."""
+        server = self.ranked(servers)[0]
+        servers.remove(server)
+        return server
+    
+    def make_resolver(self, server, module=dns.resolver):
+        """Returns a resolver that only asks one server."""
+        resolver = module.Resolver(configure=False)
+        resolver.nameservers = [server]
+        resolver.port = self.resolver.port
+        return resolver
+    
+    def ask(self, server, name, rdtype, lifetime):
+        """Queries one server, recording its latency and failures."""
+        stats = self.server_stats(server)
+        stats.probing = stats.untested(time.time())
+        started = time.monotonic()
+        try:
+            result = resolve_entry(self.make_resolver(server), name, rdtype, lifetime)
+        except SERVER_ERRORS:
+            stats.record(time.monotonic() - started, True)
+            raise
+        finally:
+            stats.probing = False
+        stats.record(time.monotonic() - started, False)
+        return result
+    
+    async def ask_async(self, server, name, rdtype, lifetime):
+        """Like ask(), with an asyncio resolver."""
+        stats = self.server_stats(server)
+        stats.probing = stats.untested(time.time())
+        started = time.monotonic()
+        try:
+            result = await resolve_entry_async(self.make_resolver(server, dns.asyncresolver),
+                                               name, rdtype, lifetime)
+        except SERVER_ERRORS:
+            stats.record(time.monotonic() - started, True)
+            raise
+        finally:
+            stats.probing = False
+        stats.record(time.monotonic() - started, False)
+        return result
+    
+    def query(self, name, rdtype, servers):
+        """Asks the servers, returns (records, error class, TTL) for answers and missing names.
+        
+        Servers are tried in turn, best first, unless racing is on.
+        """
+        if self.race and len(servers) > 1:
+            return asyncio.run(self.race_servers(name, rdtype, servers, self.resolver.lifetime))
+        
+        servers = list(servers)
+        error = dns.exception.Timeout()
+        while servers:
+            try:
+                return self.ask(self.next_server(servers), name, rdtype, self.resolver.timeout)
+            except SERVER_ERRORS as e:
+                error = e
+        raise error
+    
+    async def query_async(self, name, rdtype, servers, timeout):
+        """Like query(), with asyncio and an overall timeout."""
+        if self.race and len(servers) > 1:
+            return await self.race_servers(name, rdtype, servers, timeout)
+        
+        deadline = time.monotonic() + timeout
+        servers = list(servers)
+        error = dns.exception.Timeout()
+        while servers and time.monotonic() < deadline:
+            lifetime = min(deadline - time.monotonic(), self.resolver.timeout)
+            try:
+                return await self.ask_async(self.next_server(servers), name, rdtype, lifetime)
+            except SERVER_ERRORS as e:
+                error = e
+        raise error
+    
+    async def race_servers(self, name, rdtype, servers, timeout):
+        """Sends the query to all servers at once, returns the first valid answer."""
+        pending = {asyncio.ensure_future(self.ask_async(server, name, rdtype, timeout))
+                   for server in servers}
+        try:
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                answered = [task for task in done if task.exception() is None]
+                if answered:
+                    return answered[0].result()
+                if not pending:
+                    raise next(iter(done)).exception()
+        finally:
+            # Slower servers are not counted as failed when they lose the race
+            for task in pending:
+                task.cancel()
+    
+    def cache_key(self, name, rdtype):
+        return (str(name).lower().rstrip('.'), rdtype, tuple(self.nameservers()))
+    
+    def needs_refresh(self, entry):
+        """Checks if a cached answer is used often and about to expire."""
+        return (self.refresh_ahead and entry.hits >= HOT_HITS and not entry.refreshing
+                and entry.expires - time.time() < entry.ttl * REFRESH_AHEAD)
+    
+    def lookup(self, name, rdtype):
+        """Returns the records for a name, from the cache if possible.
+        
+        Raises NXDOMAIN or NoAnswer like the resolver does, also when cached.
+        """
+        key = self.cache_key(name, rdtype)
+        entry = self.cache.get(key)
+        
+        if entry is None:
+            # Ask the specified DNS servers or the default ones
+            records, error, ttl = self.query(name, rdtype, self.nameservers())
+            self.cache.put(key, records, error, ttl)
+        else:
+            records, error = entry.records, entry.error
+            if self.needs_refresh(entry):
+                entry.refreshing = True
+                threading.Thread(target=self.refresh, args=(key, entry), daemon=True).start()
+        
+        if error is not None:
+            raise error()
+        return records
+    
+    def refresh(self, key, entry):
+        """Fetches a hot answer again before it expires."""
+        name, rdtype, nameservers = key
+        try:
+            self.cache.put(key, *self.query(name, rdtype, list(nameservers)))
+        except Exception:
+            entry.refreshing = False  # Try again on the next hit
+    
     def resolve_domain(self, domain):
         """Resolves a domain to IP addresses."""
         try:
-            # Configure the resolver with the specified DNS server or the default one
-            if self.custom_dns:
-                self.resolver.nameservers = [self.custom_dns]
-            else:
-                self.resolver.nameservers = self.system_dns
-            
             # Try to get A records (IPv4)
-            answers = self.resolver.resolve(domain, 'A')
+            answers = self.lookup(domain, 'A')
             
             print(f"IP addresses for domain {domain}:")
             for rdata in answers:
@@ -52,17 +575,11 @@ class DNSClient:
     def resolve_ip(self, ip):
         """Resolves an IP address to a domain."""
         try:
-            # Configure the resolver with the specified DNS server or the default one
-            if self.custom_dns:
-                self.resolver.nameservers = [self.custom_dns]
-            else:
-                self.resolver.nameservers = self.system_dns
-            
             # Convert the IP to reverse lookup format
             addr = dns.reversename.from_address(ip)
             
             # Get the PTR record
-            answers = self.resolver.resolve(addr, 'PTR')
+            answers = self.lookup(addr, 'PTR')
             
             print(f"Domains for IP {ip}:")
             for rdata in answers:
@@ -73,17 +590,363 @@ class DNSClient:
         except Exception as e:
             print(f"Error resolving IP {ip}: {str(e)}")
     
-    def set_dns_server(self, ip):
-        """Sets the DNS server for resolution."""
-        if not self.is_valid_ip(ip):
-            print(f"Error: '{ip}' is not a valid IP address.")
-            return False
+    async def resolve_async(self, host, timeout):
+        """Resolves a domain or an IP address for bulk mode, returns a result dict."""
+        if self.is_valid_ip(host):
+            name, rdtype = dns.reversename.from_address(host), 'PTR'
+        else:
+            name, rdtype = host, 'A'
+        result = {"query": host, "type": rdtype}
+        
+        try:
+            key = self.cache_key(name, rdtype)
+            # The cache file is used from other threads, so a locked file never stalls the loop
+            entry = self.cache.get(key, load=False)
+            if entry is None and self.cache.store is not None:
+                entry = await asyncio.get_running_loop().run_in_executor(None, self.cache.load, key)
+            if entry is None:
+                records, error, ttl = await self.query_async(name, rdtype, self.nameservers(), timeout)
+                self.cache.put(key, records, error, ttl, wait=False)
+            else:
+                records, error = entry.records, entry.error
+        except dns.exception.Timeout:
+            result["error"] = "timeout"
+        except Exception as e:
+            result["error"] = str(e)
+        else:
+            if error is not None:
+                result["error"] = error.__name__
+            else:
+                result["answers"] = records
+        return result
+    
+    async def resolve_bulk(self, source, output, limit=BULK_LIMIT, timeout=BULK_TIMEOUT, ordered=False):
+        """Resolves the hosts read from a file concurrently, writing one JSON line per host.
+        
+        Results are written as they complete, or in input order if ordered is set.
+        Returns the number of hosts and of failed lookups.
+        """
+        loop = asyncio.get_running_loop()
+        
+        # A bounded queue keeps memory flat however long the input is
+        queue = asyncio.Queue(limit * 2)
+        pending = {}  # index -> result, waiting for earlier results in ordered mode
+        counts = {"hosts": 0, "failed": 0, "written": 0}
+        
+        def write(result):
+            output.write(json.dumps(result) + "\n")
+            counts["written"] += 1
+        
+        async def produce():
+            while True:
+                # Blocking reads (stdin) happen outside the event loop
+                lines = await loop.run_in_executor(None, source.readlines, READ_HINT)
+                if not lines:
+                    break
+                for line in lines:
+                    host = line.strip()
+                    if host and not host.startswith('#'):
+                        await queue.put((counts["hosts"], host))
+                        counts["hosts"] += 1
+            for _ in range(limit):
+                await queue.put(None)
+        
+        async def work():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                index, host = item
+                result = await self.resolve_async(host, timeout)
+                if "error" in result:
+                    counts["failed"] += 1
+                if not ordered:
+                    write(result)
+                    continue
+                pending[index] = result
+                while counts["written"] in pending:
+                    write(pending.pop(counts["written"]))
+        
+        await asyncio.gather(produce(), *(work() for _ in range(limit)))
+        output.flush()
+        return counts["hosts"], counts["failed"]
+    
+    def run_bulk(self, args):
+        """Runs the bulk command: resolve every host of a file or stdin."""
+        parser = argparse.ArgumentParser(prog="bulk", description="Resolve many hosts concurrently, "
+                                         "writing one JSON line per host")
+        parser.add_argument("file", help="file with one domain or IP per line, - for stdin")
+        parser.add_argument("--limit", type=int, default=BULK_LIMIT, help="queries in flight at once")
+        parser.add_argument("--timeout", type=float, default=BULK_TIMEOUT, help="seconds per query")
+        parser.add_argument("--ordered", action="store_true", help="write results in input order")
+        parser.add_argument("--dns", nargs="+", metavar="IP",
+                            help="DNS servers to use instead of the current ones")
+        parser.add_argument("--race", action="store_true",
+                            help="send each query to all DNS servers and take the first answer")
+        try:
+            options = parser.parse_args(args)
+        except SystemExit:
+            return  # argparse has printed the problem
+        if options.limit < 1:
+            print("Error: --limit must be at least 1", file=sys.stderr)
+            return
+        for ip in options.dns or []:
+            if not self.is_valid_ip(ip):
+                print(f"Error: '{ip}' is not a valid IP address.", file=sys.stderr)
+                return
+        
+        try:
+            source = sys.stdin if options.file == "-" else open(options.file)
+        except OSError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return
+        
+        # --dns and --race only apply to this run
+        saved = self.custom_dns, self.race
+        if options.dns:
+            self.custom_dns = options.dns
+        if options.race:
+            self.race = True
         
-        # Set the new DNS server
-        self.custom_dns = ip
-        print(f"DNS server has been changed to {ip}")
+        # Progress and the summary go to stderr, so stdout is only JSON lines
+        started = time.time()
+        try:
+            with source:
+                hosts, failed = asyncio.run(self.resolve_bulk(source, sys.stdout, options.limit,
+                                                              options.timeout, options.ordered))
+        finally:
+            self.custom_dns, self.race = saved
+            if self.cache.store is not None:
+                self.cache.store.flush()  # Answers the writer thread has not stored yet
+        elapsed = time.time() - started
+        print(f"Resolved {hosts} hosts in {elapsed:.2f} s "
+              f"({hosts / elapsed if elapsed else 0:.0f}/s), {failed} failed", file=sys.stderr)
+    
+    def answer_query(self, wire, tcp=False):
+        """Answers a DNS query in wire format.
+        
+        Returns the reply from the cache, a coroutine returning the reply once
+        it has been resolved upstream, or None for packets that are not queries.
+        """
+        try:
+            query = dns.message.from_wire(wire)
+        except dns.exception.DNSException:
+            return None
+        if query.flags & dns.flags.QR:
+            return None
+        if query.opcode() != dns.opcode.QUERY:
+            return self.reply(query, tcp, rcode=dns.rcode.NOTIMP)
+        if len(query.question) != 1:
+            return self.reply(query, tcp, rcode=dns.rcode.FORMERR)
+        question = query.question[0]
+        if question.rdclass != dns.rdataclass.IN:
+            return self.reply(query, tcp, rcode=dns.rcode.REFUSED)
+        
+        key = self.cache_key(question.name, dns.rdatatype.to_text(question.rdtype))
+        # The cache file is read on another thread, so a locked file never stalls the loop
+        entry = self.cache.get(key, load=False)
+        if entry is None:
+            return self.answer_later(query, key, tcp)
+        
+        if self.needs_refresh(entry):
+            entry.refreshing = True
+            self.fetch(key, load=False)
+        return self.reply(query, tcp, entry.records, entry.error, entry.expires - time.time())
+    
+    async def answer_later(self, query, key, tcp):
+        try:
+            records, error, ttl = await asyncio.shield(self.fetch(key))
+        except Exception:
+            return self.reply(query, tcp, rcode=dns.rcode.SERVFAIL)
+        return self.reply(query, tcp, records, error, ttl)
+    
+    def fetch(self, key, load=True):
+        """Resolves a cache key upstream, with one query for all who ask at the same time.
+        
+        With load set, the cache file is searched first.
+        """
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.ensure_future(self.fetch_upstream(key, load))
+            
+            def done(task):
+                del self.inflight[key]
+                if task.cancelled() or task.exception() is not None:
+                    # Refreshes have nobody waiting for the error; try again on the next hit
+                    entry = self.cache.entries.get(key)
+                    if entry is not None:
+                        entry.refreshing = False
+            task.add_done_callback(done)
+        return task
+    
+    async def fetch_upstream(self, key, load):
+        if load and self.cache.store is not None:
+            entry = await asyncio.get_running_loop().run_in_executor(None, self.cache.load, key)
+            if entry is not None:
+                return entry.records, entry.error, entry.expires - time.time()
+        name, rdtype, nameservers = key
+        result = await self.query_async(name, rdtype, list(nameservers), self.resolver.lifetime)
+        self.cache.put(key, *result, wait=False)
+        return result
+    
+    def reply(self, query, tcp, records=(), error=None, ttl=0, rcode=None):
+        """Builds the wire format reply to a query."""
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.RA
+        if rcode is not None:
+            response.set_rcode(rcode)
+        elif error is dns.resolver.NXDOMAIN:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        elif records:
+            question = query.question[0]
+            response.answer.append(dns.rrset.from_text_list(
+                question.name, max(0, int(ttl)), question.rdclass, question.rdtype, records))
+        
+        if tcp:
+            max_size = 65535
+        else:
+            max_size = max(UDP_SIZE, query.payload) if query.edns >= 0 else UDP_SIZE
+        try:
+            return response.to_wire(max_size=max_size)
+        except dns.exception.TooBig:
+            # The client should ask again over TCP
+            response.answer.clear()
+            response.flags |= dns.flags.TC
+            return response.to_wire()
+    
+    async def serve_tcp(self, reader, writer):
+        """Answers the DNS queries of one TCP connection.
+        
+        Pipelined queries are answered concurrently, each as soon as it is
+        resolved, so a slow upstream query does not hold back cache hits.
+        """
+        pending = set()
+        try:
+            while True:
+                size = await asyncio.wait_for(reader.readexactly(2), TCP_IDLE)
+                reply = self.answer_query(await reader.readexactly(int.from_bytes(size, 'big')), tcp=True)
+                if reply is None:
+                    break
+                if asyncio.iscoroutine(reply):
+                    task = asyncio.ensure_future(self.send_tcp(reply, writer))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                    if len(pending) >= TCP_PIPELINE:
+                        await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    await self.send_tcp(reply, writer)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            # Queries already read are still answered
+            if pending:
+                await asyncio.wait(pending)
+            writer.close()
+    
+    async def send_tcp(self, reply, writer):
+        """Writes one reply with its length prefix; reply may be a coroutine."""
+        if asyncio.iscoroutine(reply):
+            reply = await reply
+        try:
+            writer.write(len(reply).to_bytes(2, 'big') + reply)
+            await writer.drain()
+        except ConnectionError:
+            pass
+    
+    async def serve(self, host, port):
+        """Runs a caching DNS server on UDP and TCP until cancelled."""
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: UDPServer(self), local_addr=(host, port))
+        server = await asyncio.start_server(self.serve_tcp, host, port)
+        print(f"DNS server listening on {host}:{port} (UDP and TCP), "
+              f"forwarding to {', '.join(self.nameservers())}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            transport.close()
+    
+    def run_server(self, args):
+        """Runs the serve command."""
+        parser = argparse.ArgumentParser(prog="serve", description="Run a local caching DNS server")
+        parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+        parser.add_argument("--port", type=int, default=SERVER_PORT, help="port to listen on")
+        parser.add_argument("--dns", nargs="+", metavar="IP", help="upstream DNS servers")
+        parser.add_argument("--race", action="store_true",
+                            help="send each query to all upstream servers and take the first answer")
+        try:
+            options = parser.parse_args(args)
+        except SystemExit:
+            return  # argparse has printed the problem
+        for ip in options.dns or []:
+            if not self.is_valid_ip(ip):
+                print(f"Error: '{ip}' is not a valid IP address.")
+                return
+        
+        # --dns and --race only apply while the server runs
+        saved = self.custom_dns, self.race
+        if options.dns:
+            self.custom_dns = options.dns
+        if options.race:
+            self.race = True
+        
+        try:
+            asyncio.run(self.serve(options.host, options.port))
+        except OSError as e:
+            print(f"Error: cannot listen on {options.host}:{options.port}: {e}")
+        except KeyboardInterrupt:
+            print("\nDNS server stopped")
+        finally:
+            self.custom_dns, self.race = saved
+            if self.cache.store is not None:
+                self.cache.store.flush()
+    
+    def set_dns_servers(self, ips):
+        """Sets the DNS servers for resolution."""
+        for ip in ips:
+            if not self.is_valid_ip(ip):
+                print(f"Error: '{ip}' is not a valid IP address.")
+                return False
+        
+        # Set the new DNS servers
+        self.custom_dns = list(ips)
+        if len(ips) == 1:
+            print(f"DNS server has been changed to {ips[0]}")
+        else:
+            print(f"DNS servers have been changed to {', '.join(ips)}")
         return True
     
+    def show_servers(self, args):
+        """Shows the DNS servers with their statistics, best first, or toggles racing."""
+        if args[:1] == ["race"] and args[1:2] in (["on"], ["off"]):
+            self.race = args[1] == "on"
+            print(f"Racing is {args[1]}")
+            return
+        
+        print(f"DNS servers (racing {'on' if self.race else 'off'}):")
+        for server in self.ranked(self.nameservers()):
+            stats = self.stats.get(server)
+            if stats is None or not stats.queries:
+                print(f"- {server}: no queries yet")
+            else:
+                print(f"- {server}: {stats.latency * 1000:.1f} ms, "
+                      f"{stats.failure_rate * 100:.0f}% failing, {stats.queries} queries")
+    
+    def show_cache(self, args):
+        """Shows cache statistics, or clears the cache or toggles refresh-ahead."""
+        if args[:1] == ["clear"]:
+            self.cache.clear()
+            print("Cache has been cleared")
+        elif args[:1] == ["refresh"] and args[1:2] in (["on"], ["off"]):
+            self.refresh_ahead = args[1] == "on"
+            print(f"Refresh-ahead is {args[1]}")
+        else:
+            print(f"Cache: {len(self.cache.entries)}/{self.cache.size} answers, "
+                  f"{self.cache.hits} hits, {self.cache.misses} misses, "
+                  f"refresh-ahead {'on' if self.refresh_ahead else 'off'}")
+            if self.cache.store is not None:
+                print(f"Cache file: {self.cache.store.path}, {self.cache.disk_hits} hits")
+    
     def process_command(self, cmd_args):
         """Processes user commands."""
         if not cmd_args:
@@ -100,7 +963,19 @@ class DNSClient:
                 self.resolve_domain(host)
         
         elif cmd == "use" and len(cmd_args) >= 3 and cmd_args[1].lower() == "dns":
-            self.set_dns_server(cmd_args[2])
+            self.set_dns_servers(cmd_args[2:])
+        
+        elif cmd == "servers":
+            self.show_servers([arg.lower() for arg in cmd_args[1:]])
+        
+        elif cmd == "bulk" and len(cmd_args) >= 2:
+            self.run_bulk(cmd_args[1:])
+        
+        elif cmd == "serve":
+            self.run_server(cmd_args[1:])
+        
+        elif cmd == "cache":
+            self.show_cache([arg.lower() for arg in cmd_args[1:]])
         
         else:
             self.show_usage()
@@ -109,7 +984,11 @@ class DNSClient:
         """Displays usage instructions."""
         print("Usage:")
         print("  resolve <domain/IP> - resolves a domain to IP or an IP to domain")
-        print("  use dns <IP> - changes the DNS server used for resolution")
+        print("  use dns <IP> [<IP> ...] - changes the DNS servers used for resolution")
+        print("  servers [race on/off] - shows the DNS servers, or asks all of them at once")
+        print("  bulk <file> [--limit N] [--timeout S] [--ordered] [--dns IP ...] [--race] - resolves many hosts concurrently")
+        print("  serve [--host IP] [--port N] [--dns IP ...] [--race] - runs a local caching DNS server")
+        print("  cache [clear | refresh on/off] - shows or clears the answer cache")
 
 def main():
     # Check if the dnspython library is installed
@@ -120,15 +999,21 @@ def main():
         print("Install it using the command: pip install dnspython")
         sys.exit(1)
     
-    client = DNSClient()
+    # The cache file option can be given with any command
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--cache-file", default=os.environ.get("DNS_CACHE_FILE"))
+    parser.add_argument("--race", action="store_true")
+    options, command = parser.parse_known_args()
+    
+    client = DNSClient(cache_file=options.cache_file, race=options.race)
     
-    if len(sys.argv) > 1:
+    if command:
         # Command line mode
-        client.process_command(sys.argv[1:])
+        client.process_command(command)
     else:
         # Interactive mode
         print("DNS Client - Type 'quit' to exit")
-        print("Available commands: 'resolve <domain/IP>', 'use dns <IP>'")
+        print("Available commands: 'resolve <domain/IP>', 'use dns <IP>', 'servers', 'bulk <file>', 'cache'")
         
         while True:
             try:
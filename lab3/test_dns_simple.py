@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""Loopback checks for the serve and bulk modes of dns_simple.py, run with: python -m pytest lab3
+
+A stub upstream server on the loopback interface answers A queries, so no
+internet access is needed.
+"""
+import asyncio
+import io
+import sqlite3
+import time
+from collections import Counter
+
+import dns.asyncquery
+import dns.message
+import dns.rrset
+
+from dns_simple import DNSClient
+
+UPSTREAM_PORT = 47700  # Stub upstream server
+SERVER_PORT = 47701    # DNSClient in serve mode, UDP and TCP
+SLOW_DELAY = 1.0       # Seconds the stub waits before answering names starting with "slow"
+
+
+class StubUpstream(asyncio.DatagramProtocol):
+    """Answers every A query with 10.0.0.1, counting the queries per name"""
+
+    def __init__(self):
+        self.transport = None
+        self.queries = Counter()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        query = dns.message.from_wire(data)
+        name = query.question[0].name
+        self.queries[name.to_text().rstrip('.')] += 1
+        response = dns.message.make_response(query)
+        response.answer.append(dns.rrset.from_text(name, 60, "IN", "A", "10.0.0.1"))
+        delay = SLOW_DELAY if name.to_text().startswith("slow") else 0
+        asyncio.get_running_loop().call_later(delay, self.transport.sendto, response.to_wire(), addr)
+
+
+async def start_server(cache_file=None):
+    """The stub upstream and a DNSClient serving on SERVER_PORT that forwards to it"""
+    loop = asyncio.get_running_loop()
+    transport, upstream = await loop.create_datagram_endpoint(
+        StubUpstream, local_addr=("127.0.0.1", UPSTREAM_PORT))
+    client = DNSClient(cache_file=cache_file)
+    client.custom_dns = ["127.0.0.1"]
+    client.resolver.port = UPSTREAM_PORT
+    server = asyncio.ensure_future(client.serve("127.0.0.1", SERVER_PORT))
+    await asyncio.sleep(0.1)
+
+    async def stop():
+        server.cancel()
+        await asyncio.gather(server, return_exceptions=True)
+        transport.close()
+    return client, upstream, stop
+
+
+async def ask(name):
+    """Sends one query over UDP, returns (answer, seconds taken)"""
+    started = time.monotonic()
+    response = await dns.asyncquery.udp(dns.message.make_query(name, "A"), "127.0.0.1",
+                                        port=SERVER_PORT, timeout=5)
+    return [str(rdata) for rrset in response.answer for rdata in rrset], time.monotonic() - started
+
+
+def test_identical_misses_share_one_upstream_query():
+    async def run():
+        client, upstream, stop = await start_server()
+        answers = await asyncio.gather(*(ask("same.test") for _ in range(20)))
+        await stop()
+        return [answer for answer, _ in answers], upstream.queries["same.test"]
+
+    answers, queries = asyncio.run(run())
+    assert answers == [["10.0.0.1"]] * 20
+    assert queries == 1
+
+
+def test_cache_hits_do_not_wait_for_a_slow_miss_on_the_same_tcp_connection():
+    async def run():
+        client, upstream, stop = await start_server()
+        await ask("fast.test")
+
+        # Two pipelined queries: a slow miss, then a cache hit
+        reader, writer = await asyncio.open_connection("127.0.0.1", SERVER_PORT)
+        for name in ("slow.test", "fast.test"):
+            wire = dns.message.make_query(name, "A").to_wire()
+            writer.write(len(wire).to_bytes(2, 'big') + wire)
+        started = time.monotonic()
+        replies = []
+        for _ in range(2):
+            size = int.from_bytes(await reader.readexactly(2), 'big')
+            response = dns.message.from_wire(await reader.readexactly(size))
+            replies.append((response.question[0].name.to_text(), time.monotonic() - started))
+        writer.close()
+        await stop()
+        return replies
+
+    (first, first_seconds), (second, _) = asyncio.run(run())
+    assert (first, second) == ("fast.test.", "slow.test.")
+    assert first_seconds < SLOW_DELAY / 2
+
+
+def test_a_locked_cache_file_does_not_stall_the_server(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+
+    async def run():
+        client, upstream, stop = await start_server(cache_file=path)
+        await ask("fast.test")
+
+        # Another process holds the write lock of the cache file
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute("BEGIN EXCLUSIVE")
+        _, miss_seconds = await ask("new.test")
+        _, hit_seconds = await ask("fast.test")
+        other.execute("ROLLBACK")
+
+        # The answer reaches the file once the lock is released
+        deadline = time.monotonic() + 5
+        stored = 0
+        while not stored and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            stored = other.execute("SELECT COUNT(*) FROM answers WHERE name = 'new.test'").fetchone()[0]
+        other.close()
+        await stop()
+        return miss_seconds, hit_seconds, stored
+
+    miss_seconds, hit_seconds, stored = asyncio.run(run())
+    assert miss_seconds < 1
+    assert hit_seconds < 1
+    assert stored == 1
+
+
+def test_a_locked_cache_file_does_not_stall_bulk_mode(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    client = DNSClient(cache_file=path)
+    client.custom_dns = ["127.0.0.1"]
+    client.resolver.port = UPSTREAM_PORT
+    client.cache.store.open()
+
+    async def run():
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            StubUpstream, local_addr=("127.0.0.1", UPSTREAM_PORT))
+        output = io.StringIO()
+        started = time.monotonic()
+        hosts = await client.resolve_bulk(io.StringIO("a.test\nb.test\nc.test\nd.test\n"), output, limit=4)
+        transport.close()
+        return hosts, time.monotonic() - started
+
+    # Another process holds the write lock of the cache file during the run
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN EXCLUSIVE")
+    hosts, seconds = asyncio.run(run())
+    other.execute("ROLLBACK")
+
+    client.cache.store.flush()
+    deadline = time.monotonic() + 5
+    stored = 0
+    while stored < 4 and time.monotonic() < deadline:
+        time.sleep(0.05)
+        stored = other.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+    other.close()
+    assert hosts == (4, 0)
+    assert seconds < 1
+    assert stored == 4
+
+
+def test_a_failed_refresh_is_tried_again():
+    client = DNSClient(refresh_ahead=True)
+    client.custom_dns = ["127.0.0.1"]
+    client.resolver.port = UPSTREAM_PORT  # Nothing answers there
+    client.resolver.lifetime = client.resolver.timeout = 0.2
+    key = client.cache_key("hot.test", "A")
+    client.cache.put(key, ["10.0.0.1"], None, 60)
+    entry = client.cache.get(key)
+    entry.refreshing = True
+
+    async def run():
+        await asyncio.gather(client.fetch(key, load=False), return_exceptions=True)
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert not entry.refreshing